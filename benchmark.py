@@ -0,0 +1,420 @@
+"""benchmark
+
+This module measures the post processing of the ml model without a camera or a broker.
+The vectorized yolo decoder, the array based nms and the input preprocessing are compared against the former
+implementations.
+With a model the throughput of the interpreter pool is measured for several settings.
+A recorded video or a directory of images can be replayed through all steps of a frame, the timings of the
+stages are written to a json file. Without the model a small synthetic model with the same outputs is used.
+"""
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import timeit
+import cv2
+import numpy as np
+import tensorflow as tf
+from absl import app, flags
+
+import frame_buffer
+import metrics
+import nms
+import utility
+import yolov4_tiny
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('bench_runs', 200, 'amount of runs per measured function')
+flags.DEFINE_integer('bench_classes', 4, 'amount of classes of the synthetic network output')
+flags.DEFINE_float('bench_obj_ratio', 0.05, 'ratio of cells with an objectness above the threshold')
+flags.DEFINE_integer('bench_seed', 0, 'seed for the synthetic network output')
+flags.DEFINE_list('bench_nms_sizes', ['10', '100', '500'], 'amount of candidate boxes for the nms benchmark')
+flags.DEFINE_boolean('bench_pool', False, 'measure the throughput of the interpreter pool, needs the model')
+flags.DEFINE_list('bench_pool_counts', ['1', '2', '4'], 'amount of interpreters in the pool to measure')
+flags.DEFINE_list('bench_pool_threads', ['1', '2', '4'], 'threads per interpreter to measure')
+flags.DEFINE_integer('bench_frames', 100, 'amount of frames run through the model per setting')
+flags.DEFINE_string('bench_replay', None, 'video or directory of images replayed through all steps of a frame')
+flags.DEFINE_integer('bench_max_frames', 0, 'max amount of replayed frames, 0 for all')
+flags.DEFINE_integer('bench_warmup', 5, 'replayed frames not measured, while the interpreter warms up')
+flags.DEFINE_string('bench_results', './bench_results.json', 'json file the results of the replay are written to')
+flags.DEFINE_boolean('bench_synthetic_model', False,
+                     'use a small synthetic model, also used if the model of model_path does not exist')
+
+
+class NullClient:
+    """Mqtt client that drops every message."""
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        pass
+
+
+class BenchCam:
+    """Stand in for a camera, without any mqtt connection."""
+
+    def __init__(self, img_height, img_width, name="bench", telemetry=None):
+        self.id = 0
+        self.name = name
+        self.img_height = img_height
+        self.img_width = img_width
+        self.last_img = None
+        self.telemetry = telemetry
+        self.publisher = None
+        self.client = NullClient()
+        self.topic = f"bench/{name}"
+        self.mqtt_topics = {'detection_info': 'detection', 'image': 'image', 'stats': 'stats'}
+
+
+def decode_netout_loop(netout, anchors, obj_thresh, net_size, nb_box, scales_x_y):
+    """Former decoder of TfLiteInterpreter, kept as reference for the vectorized one."""
+    grid_h, grid_w = netout.shape[:2]
+    netout = netout.reshape((grid_h, grid_w, nb_box, -1))
+
+    boxes = []
+    netout[..., :2] = yolov4_tiny.TfLiteInterpreter._sigmoid(netout[..., :2])  # x, y
+    netout[..., :2] = netout[..., :2] * scales_x_y - 0.5 * (scales_x_y - 1.0)  # scale x, y
+
+    netout[..., 4:] = yolov4_tiny.TfLiteInterpreter._sigmoid(netout[..., 4:])  # objectness + classes probabilities
+
+    for i in range(grid_h * grid_w):
+
+        row = i / grid_w
+        col = i % grid_w
+
+        for b in range(nb_box):
+            # 4th element is objectness
+            objectness = netout[int(row)][int(col)][b][4]
+
+            if objectness > obj_thresh:
+                # first 4 elements are x, y, w, and h
+                x, y, w, h = netout[int(row)][int(col)][b][:4]
+                x = (col + x) / grid_w  # center position, unit: image width
+                y = (row + y) / grid_h  # center position, unit: image height
+                w = anchors[2 * b + 0] * np.exp(w) / net_size  # unit: image width
+                h = anchors[2 * b + 1] * np.exp(h) / net_size  # unit: image height
+
+                # last elements are class probabilities
+                classes = objectness * netout[int(row)][col][b][5:]
+                classes *= classes > obj_thresh
+                boxes.append((x - w / 2, y - h / 2, x + w / 2, y + h / 2, objectness, classes))
+    return boxes
+
+
+def _interval_overlap(interval_a, interval_b):
+    x1, x2 = interval_a
+    x3, x4 = interval_b
+    if x3 < x1:
+        if x4 < x1:
+            return 0
+        else:
+            return min(x2, x4) - x1
+    else:
+        if x2 < x3:
+            return 0
+        else:
+            return min(x2, x4) - x3
+
+
+def bbox_iou(box1, box2):
+    intersect_w = _interval_overlap([box1[0], box1[2]], [box2[0], box2[2]])
+    intersect_h = _interval_overlap([box1[1], box1[3]], [box2[1], box2[3]])
+    intersect = intersect_w * intersect_h
+    w1, h1 = box1[2] - box1[0], box1[3] - box1[1]
+    w2, h2 = box2[2] - box2[0], box2[3] - box2[1]
+    union = w1 * h1 + w2 * h2 - intersect
+    return float(intersect) / union
+
+
+def do_nms_loop(boxes, classes, nms_thresh):
+    """Former class aware nms of TfLiteInterpreter, kept as reference for the array based one."""
+    if len(boxes) > 0:
+        nb_class = len(classes[0])
+    else:
+        return
+    for c in range(nb_class):
+        sorted_indices = np.argsort([-box_classes[c] for box_classes in classes], kind='stable')
+        for i in range(len(sorted_indices)):
+            index_i = sorted_indices[i]
+            if classes[index_i][c] == 0:
+                continue
+            for j in range(i + 1, len(sorted_indices)):
+                index_j = sorted_indices[j]
+                if bbox_iou(boxes[index_i], boxes[index_j]) >= nms_thresh:
+                    classes[index_j][c] = 0
+
+
+def synthetic_boxes(num_boxes, nb_class, rng):
+    """Random clustered boxes in image coordinates with sparse class scores."""
+    size = FLAGS.input_size
+    centers = rng.random((max(num_boxes // 8, 1), 2)) * size
+    xy = centers[rng.integers(0, len(centers), num_boxes)] + rng.normal(0, 8, (num_boxes, 2))
+    wh = rng.uniform(10, 80, (num_boxes, 2))
+    boxes = np.concatenate((xy - wh / 2, xy + wh / 2), axis=1).astype(np.int64)
+    classes = rng.random((num_boxes, nb_class)).astype(np.float32)
+    classes *= classes > 0.5
+    return boxes, classes
+
+
+def bench_nms():
+    rng = np.random.default_rng(FLAGS.bench_seed)
+    thresh = yolov4_tiny.TfLiteInterpreter.nms_thresh
+    for num_boxes in map(int, FLAGS.bench_nms_sizes):
+        boxes, classes = synthetic_boxes(num_boxes, FLAGS.bench_classes, rng)
+        reference = classes.copy()
+        do_nms_loop(boxes.tolist(), reference, thresh)
+        result = nms.non_max_suppression(boxes, classes.copy(), thresh)
+        if not np.array_equal(reference, result):
+            raise ValueError(f"Nms differs for {num_boxes} boxes")
+
+        runs = max(FLAGS.bench_runs // num_boxes, 1)
+        loop_time = timeit.timeit(lambda: do_nms_loop(boxes.tolist(), classes.copy(), thresh),
+                                  number=runs) / runs
+        vec_time = timeit.timeit(lambda: nms.non_max_suppression(boxes, classes.copy(), thresh),
+                                 number=FLAGS.bench_runs) / FLAGS.bench_runs
+        kept = np.count_nonzero(result)
+        print(f"nms {num_boxes} boxes: {kept} scores kept, loop {loop_time * 1000:.3f} ms, "
+              f"array {vec_time * 1000:.3f} ms, speedup {loop_time / vec_time:.1f}x")
+
+
+def synthetic_netout(grid, nb_box, nb_class, obj_ratio, rng):
+    """Random raw network output, obj_ratio of all cells pass the objectness threshold."""
+    netout = rng.normal(0, 1.5, (grid, grid, nb_box * (5 + nb_class))).astype(np.float32)
+    netout = netout.reshape((grid, grid, nb_box, -1))
+    netout[..., 4] = np.where(rng.random((grid, grid, nb_box)) < obj_ratio, 4., -4.)
+    return netout.reshape((grid, grid, -1))
+
+
+def compare_decoders(netout, anchors, scales_x_y):
+    net_size = FLAGS.input_size
+    thresh = yolov4_tiny.TfLiteInterpreter.obj_thresh
+    reference = decode_netout_loop(netout.copy(), anchors, thresh, net_size, 3, scales_x_y)
+    dets = yolov4_tiny.TfLiteInterpreter.decode_netout(netout.copy(), anchors, thresh, net_size, 3, scales_x_y)
+    if len(reference) != len(dets):
+        raise ValueError(f"Decoders differ in amount of boxes: {len(reference)} != {len(dets)}")
+    if reference:
+        ref_boxes = np.array([box[:4] for box in reference], dtype=np.float64)
+        ref_objness = np.array([box[4] for box in reference])
+        ref_classes = np.array([box[5] for box in reference])
+        if not (np.allclose(ref_boxes, dets.boxes, atol=1e-6) and np.allclose(ref_objness, dets.objness)
+                and np.allclose(ref_classes, dets.classes)):
+            raise ValueError("Decoders differ in the decoded boxes")
+
+    loop_time = timeit.timeit(
+        lambda: decode_netout_loop(netout.copy(), anchors, thresh, net_size, 3, scales_x_y),
+        number=FLAGS.bench_runs) / FLAGS.bench_runs
+    vec_time = timeit.timeit(
+        lambda: yolov4_tiny.TfLiteInterpreter.decode_netout(netout.copy(), anchors, thresh, net_size, 3,
+                                                            scales_x_y),
+        number=FLAGS.bench_runs) / FLAGS.bench_runs
+    return len(dets), loop_time, vec_time
+
+
+def bench_decode():
+    rng = np.random.default_rng(FLAGS.bench_seed)
+    grids = [FLAGS.input_size // 32, FLAGS.input_size // 16]
+    for i, grid in enumerate(grids):
+        netout = synthetic_netout(grid, 3, FLAGS.bench_classes, FLAGS.bench_obj_ratio, rng)
+        num_boxes, loop_time, vec_time = compare_decoders(netout, yolov4_tiny.TfLiteInterpreter.anchors[i],
+                                                          yolov4_tiny.TfLiteInterpreter.scales_x_y[i])
+        print(f"decode {grid}x{grid}: {num_boxes} boxes, loop {loop_time * 1000:.3f} ms, "
+              f"vectorized {vec_time * 1000:.3f} ms, speedup {loop_time / vec_time:.1f}x")
+
+
+def preprocess_copy(image_data, input_tensor):
+    """Former preprocessing of TfLiteInterpreter, including the copy of set_tensor."""
+    image_data = image_data / 255.  # Int -> Float64
+    image_data = image_data[np.newaxis, ...].astype(np.float32)
+    input_tensor[...] = image_data
+
+
+def bench_preprocess():
+    rng = np.random.default_rng(FLAGS.bench_seed)
+    image_data = rng.integers(0, 256, (FLAGS.input_size, FLAGS.input_size, 3), dtype=np.uint8)
+    input_tensor = np.empty((1, FLAGS.input_size, FLAGS.input_size, 3), dtype=np.float32)
+    reference = np.empty_like(input_tensor)
+    preprocess_copy(image_data, reference)
+    yolov4_tiny.TfLiteInterpreter.write_input(image_data, input_tensor[0], (0.0, 0))
+    if not np.array_equal(reference, input_tensor):
+        raise ValueError("Preprocessing differs")
+
+    copy_time = timeit.timeit(lambda: preprocess_copy(image_data, reference),
+                              number=FLAGS.bench_runs) / FLAGS.bench_runs
+    float_time = timeit.timeit(lambda: yolov4_tiny.TfLiteInterpreter.write_input(image_data, input_tensor[0],
+                                                                                 (0.0, 0)),
+                               number=FLAGS.bench_runs) / FLAGS.bench_runs
+    int8_tensor = np.empty(input_tensor.shape, dtype=np.int8)
+    int8_time = timeit.timeit(lambda: yolov4_tiny.TfLiteInterpreter.write_input(image_data, int8_tensor[0],
+                                                                                (1 / 255., -128)),
+                              number=FLAGS.bench_runs) / FLAGS.bench_runs
+    print(f"preprocess: copies {copy_time * 1000:.3f} ms, in place float32 {float_time * 1000:.3f} ms, "
+          f"int8 {int8_time * 1000:.3f} ms")
+
+
+def bench_pool():
+    select_model()
+    rng = np.random.default_rng(FLAGS.bench_seed)
+    image_data = rng.integers(0, 256, (FLAGS.input_size, FLAGS.input_size, 3), dtype=np.uint8)
+    cam = BenchCam(FLAGS.input_size, FLAGS.input_size)
+    for count in map(int, FLAGS.bench_pool_counts):
+        for threads in map(int, FLAGS.bench_pool_threads):
+            pool = yolov4_tiny.InterpreterPool(count, threads)
+            start = time.time()
+            done = 0
+            for _ in range(FLAGS.bench_frames):
+                pool.submit(None, image_data, cam)
+                done += len(pool.results(timeout=0))
+            while done < FLAGS.bench_frames:
+                done += len(pool.results(timeout=1))
+            fps = FLAGS.bench_frames / (time.time() - start)
+            pool.close()
+            print(f"pool {count} interpreters x {threads} threads: {fps:.1f} frames/s")
+
+
+def synthetic_model(path, input_size, num_classes):
+    """Writes a small untrained model with the inputs and outputs of the yolov4 tiny model."""
+    channels = 3 * (5 + num_classes)
+    inputs = tf.keras.Input((input_size, input_size, 3), batch_size=1)
+    x = inputs
+    outputs = {}
+    for stride, filters in ((2, 8), (4, 16), (8, 16), (16, 32), (32, 32)):
+        x = tf.keras.layers.Conv2D(filters, 3, strides=2, padding='same', activation='relu')(x)
+        if stride in (16, 32):
+            outputs[stride] = tf.keras.layers.Conv2D(channels, 1, name=f"yolo_{32 // stride}")(x)
+    # same order as the model, the coarse grid first
+    model = tf.keras.Model(inputs, [outputs[32], outputs[16]])
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    with open(path, 'wb') as file:
+        file.write(converter.convert())
+    return path
+
+
+# Uses the synthetic model if asked for or if there is no model
+# The converter runs in its own process, its memory would otherwise be the peak rss of the replay
+def select_model():
+    if FLAGS.bench_synthetic_model or not os.path.exists(FLAGS.model_path):
+        path = os.path.join(tempfile.mkdtemp(), "synthetic.tflite")
+        num_classes = len(utility.read_info(FLAGS.classes_file))
+        process = multiprocessing.get_context('spawn').Process(target=synthetic_model,
+                                                                args=(path, FLAGS.input_size, num_classes))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise ValueError(f"Error: synthetic model not converted, exit code {process.exitcode}")
+        FLAGS.model_path = path
+        print(f"Using synthetic model {FLAGS.model_path}")
+        return True
+    return False
+
+
+# Name and frame in BGR as read from a camera, the name is the image without extension or the frame number
+def replay_frames(path):
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            stem, ext = os.path.splitext(name)
+            if ext.lower() in ('.jpg', '.jpeg', '.png', '.bmp'):
+                frame = cv2.imread(os.path.join(path, name))
+                if frame is not None:
+                    yield stem, frame
+        return
+    vid = cv2.VideoCapture(path)
+    try:
+        index = 0
+        while True:
+            return_value, frame = vid.read()
+            if not return_value:
+                return
+            yield f"frame_{index:05d}", frame
+            index += 1
+    finally:
+        vid.release()
+
+
+# Peak memory of this process only, the process converting the synthetic model is not included
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return round(peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10, 1)
+
+
+def bench_replay():
+    synthetic = select_model()
+    interpreter = yolov4_tiny.TfLiteInterpreter()
+    frames = replay_frames(FLAGS.bench_replay)
+    cam = None
+    latency = []
+    count = 0
+    start = None
+    while not FLAGS.bench_max_frames or count < FLAGS.bench_max_frames + FLAGS.bench_warmup:
+        read_start = time.perf_counter()
+        _, frame = next(frames, (None, None))
+        if frame is None:
+            break
+        if count == FLAGS.bench_warmup or cam is None:
+            # the warm up frames are run, but not measured
+            cam = BenchCam(frame.shape[0], frame.shape[1], telemetry=metrics.Telemetry("bench", window=10 ** 6))
+            latency = []
+            start = read_start
+        frame = frame_buffer.FrameBuffer(frame, 'BGR')
+        cam.telemetry.add('capture', time.perf_counter() - read_start)
+        with metrics.measure(cam.telemetry, 'resize'):
+            image_data = frame.resized(FLAGS.input_size)
+        interpreter.iteration_step(frame, image_data, cam)
+        cam.telemetry.frame_done()
+        latency.append(time.perf_counter() - read_start)
+        count += 1
+    if not latency or count <= FLAGS.bench_warmup:
+        raise ValueError(f"Not enough frames in {FLAGS.bench_replay} after {FLAGS.bench_warmup} warm up frames")
+
+    elapsed = time.perf_counter() - start
+    latency_ms = np.array(latency) * 1000
+    p50, p95, p99 = np.percentile(latency_ms, [50, 95, 99])
+    results = {
+        'source': FLAGS.bench_replay,
+        'model': FLAGS.model_path,
+        'synthetic_model': synthetic,
+        'input_size': FLAGS.input_size,
+        'interpreter_threads': FLAGS.interpreter_threads,
+        'frames': len(latency),
+        'fps': len(latency) / elapsed,
+        'latency_ms': {'mean': float(latency_ms.mean()), 'p50': float(p50), 'p95': float(p95), 'p99': float(p99)},
+        'stages_ms': cam.telemetry.summary(),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    for stage, st in results['stages_ms'].items():
+        print(f"{stage}: {st['count']} x, mean {st['mean']:.2f} ms, p50 {st['p50']:.2f} ms, "
+              f"p95 {st['p95']:.2f} ms, p99 {st['p99']:.2f} ms")
+    print(f"replay {results['frames']} frames: {results['fps']:.1f} frames/s, latency p50 {p50:.2f} ms, "
+          f"p95 {p95:.2f} ms, p99 {p99:.2f} ms, peak rss {results['peak_rss_mb']} MB")
+    if FLAGS.bench_results:
+        with open(FLAGS.bench_results, 'w') as file:
+            json.dump(results, file, indent=2)
+    return results
+
+
+def main(_argv):
+    if FLAGS.bench_replay is not None:
+        bench_replay()
+        return
+    bench_decode()
+    bench_nms()
+    bench_preprocess()
+    if FLAGS.bench_pool:
+        bench_pool()
+
+
+if __name__ == '__main__':
+    FLAGS(sys.argv)
+    try:
+        app.run(main)
+    except SystemExit:
+        pass
+else:
+    pass
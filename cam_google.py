@@ -10,6 +10,7 @@ import paho.mqtt.client as mqtt
 from absl import app, flags
 from paho.mqtt.client import ssl
 
+import capture
 import utility
 
 FLAGS = flags.FLAGS
@@ -113,8 +114,11 @@ def main(_argv):
     cam = Cam()
     mqtt_topic_img = f"/devices/{FLAGS.device_id}/events/image"
 
-    vid = cv2.VideoCapture(select_cam_type())
-    vid.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    if FLAGS.threaded_capture:
+        vid = capture.FrameGrabber(select_cam_type(), drop_frames=FLAGS.cam_type != "video")
+    else:
+        vid = cv2.VideoCapture(select_cam_type())
+        vid.set(cv2.CAP_PROP_BUFFERSIZE, 1)
     return_value, frame = vid.read()
     cam.img_height = frame.shape[0]
     cam.img_width = frame.shape[1]
@@ -129,6 +133,10 @@ def main(_argv):
             raise ValueError("No stream")
         resize_and_send(frame, mqtt_topic_img, cam)
 
+    if FLAGS.threaded_capture:
+        print(vid.report())
+    vid.release()
+
 
 if __name__ == '__main__':
     try:
@@ -7,13 +7,21 @@ The result can be viewed in window and will be sent to the given mqtt topic.
 
 Includes count of frames with extra threshold (send only, if object was detected amount x in span y)
 """
-import statistics
+import os
+import queue
+import threading
 import time
 import sys
 import cv2
 import paho.mqtt.client as mqtt
 from absl import app, flags
 
+import capture
+import frame_buffer
+import metrics
+import motion
+import pipeline
+import publisher
 import utility
 import yolov4_tiny
 
@@ -23,18 +31,24 @@ flags.DEFINE_string('cam_link', None,
                     'link to the video e.g. ip addr for ip_cam or path to video, for webcam not needed')
 flags.DEFINE_string('broker_addr', 'localhost', 'address to the master broker in the network')
 flags.DEFINE_integer('broker_port', 1883, 'port to the master broker in the network')
+flags.DEFINE_list('cam_sources', None,
+                  'several streams served by one model, each as type:link e.g. webcam:0,ip_cam:http://ip:8080/video')
 flags.DEFINE_boolean('show_stream', True, 'display the stream of camera in window')
+flags.DEFINE_boolean('pipeline', False, 'run capture, model, object handling and publishing in own threads')
+flags.DEFINE_integer('pipeline_report_interval', 30, 'seconds between two reports of the pipeline stages')
 
 
 class Cam:
     retry_time = 5  # Time in seconds when to resend cam activation request
+    frame_time_max = 25  # Amount frames measured before the detection window follows the fps
 
-    init = True  # Boolean to stop FPS calculation
-    frame_times = []
-    frame_time_max = 25  # Amount frames at beginning for fps calculation
-
-    def __init__(self, mqtt_adr, name=None):
+    def __init__(self, mqtt_adr, name=None, config_file=None):
+        if config_file is None:
+            config_file = FLAGS.cam_config_file
+        self.config_file = config_file
         self.mqtt_topics = utility.read_json(FLAGS.mqtt_config_file)
+        # configs from before the stats messages have no topic for them
+        self.mqtt_topics.setdefault('stats', 'stats')
         self.broker_adr = mqtt_adr
 
         self.id = 0
@@ -46,7 +60,16 @@ class Cam:
         self.img_width = 0
         self.last_img = None
 
+        # each stream has its own objects and fps, the model is shared
+        self.vid = None
+        self.gate = None
+        self.tiles = None
+        self.window = "result"
+        self.publisher = None  # publishes the detections in its own thread, shared by all cameras
+        self.obj_handler = yolov4_tiny.ObjectsHandler()
+
         self.activate_cam(broker_adr=mqtt_adr)
+        self.telemetry = metrics.Telemetry(self.name)
         self.topic = f"{self.mqtt_topics['device_root']}/{self.id}"
 
         self.client = mqtt.Client(str(self.id))
@@ -64,14 +87,14 @@ class Cam:
 
     def activate_cam(self, broker_adr="127.0.0.1"):
         try:
-            cam_config = utility.read_json(FLAGS.cam_config_file)
+            cam_config = utility.read_json(self.config_file)
             current_ip = utility.get_primary_ip()
             if cam_config['mqtt']['id'] != "" and cam_config['mqtt']['ip'] == current_ip:
                 self.id = cam_config['mqtt']['id']
                 self.name = cam_config['mqtt']['name']
                 cam_config['mqtt']['ip'] = self.ip
                 cam_config['mqtt']['uptime'] = self.uptime
-                utility.write_json(cam_config, FLAGS.cam_config_file)
+                utility.write_json(cam_config, self.config_file)
                 self.activated = True
                 return
             else:
@@ -116,87 +139,322 @@ class Cam:
             'uptime': self.uptime,
             'ip': self.ip,
         }}
-        utility.write_json(cam_json, FLAGS.cam_config_file)
+        utility.write_json(cam_json, self.config_file)
         client_tmp.disconnect()
         return
 
-    @staticmethod
-    def calc_fps():
-        fps = [(1 / x) for x in Cam.frame_times]
-        fps_med = statistics.median(fps)
-        Cam.init = False
-        del fps
-        del Cam.frame_times
-        return int(fps_med)
+    # Compact statistic of the stages, on the status topic of the device
+    def publish_stats(self):
+        self.client.publish(f"{self.topic}/{self.mqtt_topics['stats']}", self.telemetry.compact(), qos=0)
+
+    def open_stream(self, cam_type=None, cam_link=None, threaded=None):
+        if cam_type is None:
+            cam_type = FLAGS.cam_type
+        if threaded is None:
+            threaded = FLAGS.threaded_capture
+        if threaded:
+            self.vid = capture.FrameGrabber(select_cam_type(cam_type, cam_link), drop_frames=cam_type != "video",
+                                            telemetry=self.telemetry)
+        else:
+            self.vid = cv2.VideoCapture(select_cam_type(cam_type, cam_link))
+            self.vid.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        return_value, frame = self.vid.read()
+        if not return_value:
+            raise ValueError(f"No stream for {self.name}")
+        self.img_height = frame.shape[0]
+        self.img_width = frame.shape[1]
+        self.tiles = yolov4_tiny.TfLiteInterpreter.make_tiles(self.img_height, self.img_width)
+        self.gate = motion.MotionGate() if FLAGS.motion_gate else None
+
+    # Next frame as captured in BGR, None if a threaded stream has no new frame yet and wait is False
+    def read_frame(self, wait=True):
+        if not isinstance(self.vid, capture.FrameGrabber):
+            with metrics.measure(self.telemetry, 'capture'):
+                return_value, frame = self.vid.read()
+        elif wait:
+            return_value, frame = self.vid.read()
+        else:
+            return_value, frame = self.vid.read(timeout=0)
+            if not return_value and self.vid.thread.is_alive():
+                return None
+        if not return_value:
+            raise ValueError(f"No stream for {self.name}")
+        return frame_buffer.FrameBuffer(frame, 'BGR')
+
+    def release(self):
+        if self.gate is not None:
+            print(f"{self.name}: {self.gate.report()}")
+        if isinstance(self.vid, capture.FrameGrabber):
+            print(f"{self.name}: {self.vid.report()}")
+        self.vid.release()
+
+
+# Image for the model or the tiles with motion, both None if the motion gate skips the frame
+# Only the resized image is converted to RGB
+def preprocess(frame, gate=None, tiles=None, telemetry=None):
+    if gate is not None and not gate.check(frame.image, frame.order):
+        return None, None
+    if tiles is not None:
+        if gate is not None:
+            tiles = gate.regions_with_motion(tiles, frame.shape)
+        return None, tiles
+    with metrics.measure(telemetry, 'resize'):
+        return frame.resized(FLAGS.input_size), None
 
 
 def iteration(frame, interpreter, cam):
-    prev_time = time.time()
-    image_data = cv2.resize(frame, (FLAGS.input_size, FLAGS.input_size))
-    image, _ = interpreter.iteration_step(frame, image_data, cam)
-    print(cam.name)
+    image_data, tiles = preprocess(frame, cam.gate, cam.tiles, cam.telemetry)
+    # the same cpu time as with the pool and the pipeline, the motion check is counted by the gate itself
+    cpu_time = time.thread_time()
+    detections = interpreter.predict_frame(frame, image_data, tiles, cam.img_height, cam.img_width, cam.telemetry)
+    # without motion the model is not run, the detected objects decay by the time passed
+    image, _ = interpreter.handle_detections(frame, detections, cam, obj_handler=cam.obj_handler)
+    if not detections.skipped:
+        if cam.gate is not None:
+            cam.gate.add_inference_time(time.thread_time() - cpu_time)
+        print(cam.name)
+    show_result(image, cam)
+    frame_finished(cam, detections.skipped)
+
+
+# Frames run on several interpreters, finished frames are handled in frame order of each camera
+def pool_iteration(frame, pool, cam):
+    image_data, tiles = preprocess(frame, cam.gate, cam.tiles, cam.telemetry)
+    pool.submit(frame, image_data, cam, tiles)
+    for cam, frame, detections, cpu_time in pool.results(timeout=0):
+        # the model ran in the thread of an interpreter, its cpu time comes with the result
+        cpu_time -= time.thread_time()
+        image, _ = pool.interpreter.handle_detections(frame, detections, cam, obj_handler=cam.obj_handler)
+        cpu_time += time.thread_time()
+        if not detections.skipped:
+            if cam.gate is not None:
+                cam.gate.add_inference_time(cpu_time)
+            print(cam.name)
+        show_result(image, cam)
+        frame_finished(cam, detections.skipped)
+
+
+# One frame of each camera per round, a camera without a new frame is skipped in this round
+def run_cams(cams, interpreter, pool=None):
+    # a single camera waits for its frames as before
+    wait = len(cams) == 1
+    while True:
+        frames = 0
+        for cam in cams:
+            frame = cam.read_frame(wait)
+            if frame is None:
+                continue
+            frames += 1
+
+            #For IR to Grayscale
+            #frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+            #frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2RGB)
+
+            if pool is not None:
+                pool_iteration(frame, pool, cam)
+            else:
+                iteration(frame, interpreter, cam)
+
+        # without a window there are no keys, the loop is stopped by ctrl+c
+        if FLAGS.show_stream and cv2.waitKey(1) & 0xFF == ord('q'):
+            break
+        if not frames:
+            time.sleep(0.005)
+
+
+# Capture, preprocessing, model, object handling and publishing each run in an own stage
+def run_pipeline(cams, interpreter):
+    def prepare(item):
+        cam, frame = item
+        image_data, frame_tiles = preprocess(frame, cam.gate, cam.tiles, cam.telemetry)
+        return cam, frame, image_data, frame_tiles
+
+    # the cpu time of the model is measured in its own thread and handed on with the detections
+    def infer(item):
+        cam, frame, image_data, frame_tiles = item
+        cpu_time = -time.thread_time()
+        detections = interpreter.predict_frame(frame, image_data, frame_tiles, cam.img_height, cam.img_width,
+                                               cam.telemetry)
+        cpu_time += time.thread_time()
+        return cam, frame, detections, cpu_time
+
+    # the detections go to the publisher of the cam, which is the publishing stage
+    def handle(item):
+        cam, frame, detections, cpu_time = item
+        cpu_time -= time.thread_time()
+        image, _ = interpreter.handle_detections(frame, detections, cam, obj_handler=cam.obj_handler)
+        cpu_time += time.thread_time()
+        if not detections.skipped and cam.gate is not None:
+            cam.gate.add_inference_time(cpu_time)
+        frame_finished(cam, detections.skipped)
+        if FLAGS.show_stream:
+            return cam, image
+        return None
+
+    # the display is no thread, the main thread takes the frames
+    display = pipeline.Stage("display", maxsize=len(cams), drop_policy='drop_oldest')
+    pipe = pipeline.Pipeline([pipeline.Stage("preprocess", prepare), pipeline.Stage("infer", infer),
+                              pipeline.Stage("handle", handle), display])
+    pipe.start()
+
+    def read_frames():
+        wait = len(cams) == 1
+        while pipe_running.is_set():
+            frames = 0
+            for cam in cams:
+                try:
+                    frame = cam.read_frame(wait)
+                except ValueError as error:
+                    print(error)
+                    pipe_running.clear()
+                    return
+                if frame is not None:
+                    frames += 1
+                    pipe.put((cam, frame))
+            if not frames:
+                time.sleep(0.005)
+
+    pipe_running = threading.Event()
+    pipe_running.set()
+    capture_thread = threading.Thread(target=read_frames, daemon=True)
+    capture_thread.start()
+
+    last_report = time.time()
+    while pipe_running.is_set():
+        if FLAGS.show_stream:
+            try:
+                cam, image = display.get(timeout=0.1)
+                show_result(image, cam)
+            except queue.Empty:
+                pass
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                pipe_running.clear()
+        else:
+            time.sleep(0.1)
+        if time.time() - last_report > FLAGS.pipeline_report_interval:
+            print(pipe.report())
+            if cams[0].publisher is not None:
+                print(cams[0].publisher.report())
+            last_report = time.time()
+    capture_thread.join()
+    pipe.stop()
+    print(pipe.report())
+
+
+# The time between two finished frames is the time per frame, also with frames in parallel
+def frame_finished(cam, skipped=False):
+    cam.telemetry.frame_done(skipped)
+    update_fps(cam)
+    if cam.telemetry.report_due():
+        cam.publish_stats()
+
+
+# Without the window the boxes are only drawn for a published frame
+def show_result(frame, cam):
     if FLAGS.show_stream:
-        result = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
-        cv2.namedWindow("result", cv2.WINDOW_AUTOSIZE)
-        cv2.imshow("result", result)
+        cv2.namedWindow(cam.window, cv2.WINDOW_AUTOSIZE)
+        cv2.imshow(cam.window, frame.annotated('BGR'))
         #time.sleep(5)
 
-    curr_time = time.time()
-    exec_time = curr_time - prev_time
-    if Cam.init:
-        if len(Cam.frame_times) < Cam.frame_time_max:
-            Cam.frame_times.append(exec_time)
-        else:
-            fps = Cam.calc_fps()
-            recents = int(fps * yolov4_tiny.DetectedObject.min_time_detected)
-            #else pop from empty list will happen
-            if recents < 2:
-                recents = 2
-            yolov4_tiny.DetectedObject.recent = recents
-            print(f"Objects are detected within {yolov4_tiny.DetectedObject.recent} frames")
 
+# The window is counted in frames run through the model, frames skipped by the motion gate do not count
+# and decay the objects by the model frames that would have run in the meantime
+def update_fps(cam):
+    if cam.telemetry.frames() < Cam.frame_time_max:
+        return
+    if cam.obj_handler.update_window(cam.telemetry.model_fps()):
+        print(f"{cam.name}: Objects are detected within {cam.obj_handler.recent} frames")
 
-def select_cam_type():
+
+def select_cam_type(cam_type=None, cam_link=None):
+    if cam_type is None:
+        cam_type = FLAGS.cam_type
+        cam_link = FLAGS.cam_link
     vid_cap_arg = None
-    if FLAGS.cam_type == "webcam":
+    if cam_type == "webcam":
         print("Cam Type: Webcam")
-        vid_cap_arg = 0
-    elif FLAGS.cam_type == "ip_cam":
-        vid_cap_arg = FLAGS.cam_link  # e.g. 'http://192.168.1.179:8080/video'
-    elif FLAGS.cam_type == "video":
-        vid_cap_arg = FLAGS.cam_link  # e.g. 'C:/tmp/test.mkv'
+        # index of the webcam, only needed with several webcams
+        vid_cap_arg = webcam_index(cam_link)
+    elif cam_type == "ip_cam":
+        vid_cap_arg = cam_link  # e.g. 'http://192.168.1.179:8080/video'
+    elif cam_type == "video":
+        vid_cap_arg = cam_link  # e.g. 'C:/tmp/test.mkv'
     if vid_cap_arg is None:
         raise ValueError("Error: cam_type as arg is wrong")
     return vid_cap_arg
 
 
+def webcam_index(cam_link):
+    if not cam_link:
+        return 0
+    if not str(cam_link).isdigit():
+        raise ValueError(f"Error: link of a webcam is its index e.g. webcam:1, not {cam_link}")
+    return int(cam_link)
+
+
+# Type and link of every stream, each camera needs its own config file to keep its id
+# The first camera keeps the config file as it is, so a camera registered before keeps its id
+def read_sources():
+    if not FLAGS.cam_sources:
+        return [(FLAGS.cam_type, FLAGS.cam_link, FLAGS.cam_config_file)]
+    root, ext = os.path.splitext(FLAGS.cam_config_file)
+    sources = []
+    for i, source in enumerate(FLAGS.cam_sources):
+        cam_type, _, cam_link = source.partition(':')
+        if cam_type == "webcam":
+            # checked before any camera is registered
+            webcam_index(cam_link)
+        config_file = FLAGS.cam_config_file if i == 0 else f"{root}_{i}{ext}"
+        sources.append((cam_type, cam_link or None, config_file))
+    return sources
+
+
 def main(_argv):
-    cam = Cam(FLAGS.broker_addr)
-    interpreter = yolov4_tiny.TfLiteInterpreter()
+    sources = read_sources()
+    cams = []
+    for cam_type, cam_link, config_file in sources:
+        cam = Cam(FLAGS.broker_addr, config_file=config_file)
+        # several streams are read in turns, which needs the capture threads
+        cam.open_stream(cam_type, cam_link, threaded=FLAGS.threaded_capture or len(sources) > 1)
+        if len(sources) > 1:
+            cam.window = f"result {cam.name}"
+        cams.append(cam)
+
+    pool = None
+    if FLAGS.pipeline and FLAGS.interpreter_count > 1:
+        # the infer stage runs one interpreter, a pool would only hold memory
+        print("Warning: --interpreter_count is ignored with --pipeline, the model runs on one interpreter")
+    if FLAGS.interpreter_count > 1 and not FLAGS.pipeline:
+        pool = yolov4_tiny.InterpreterPool()
+        interpreter = pool.interpreter
+    else:
+        interpreter = yolov4_tiny.TfLiteInterpreter()
     print(interpreter.input_details)
     print(interpreter.output_details)
 
-    vid = cv2.VideoCapture(select_cam_type())
-    vid.set(cv2.CAP_PROP_BUFFERSIZE, 1)
-    return_value, frame = vid.read()
-    cam.img_height = frame.shape[0]
-    cam.img_width = frame.shape[1]
-
-    while True:
-        return_value, frame = vid.read()
-        if return_value:
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-
-            #For IR to Grayscale
-            #frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
-            #frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2RGB)
+    # in the pipeline the publisher is the stage after the object handling
+    mqtt_publisher = None
+    if FLAGS.async_publish or FLAGS.pipeline:
+        mqtt_publisher = publisher.Publisher()
+        for cam in cams:
+            cam.publisher = mqtt_publisher
+    metrics_server = None
+    if FLAGS.metrics_port is not None:
+        metrics_server = metrics.MetricsServer([cam.telemetry for cam in cams])
 
-            if cv2.waitKey(1) & 0xFF == ord('q'):
-                break
+    try:
+        if FLAGS.pipeline:
+            run_pipeline(cams, interpreter)
         else:
-            raise ValueError("No stream")
-
-        iteration(frame, interpreter, cam)
+            run_cams(cams, interpreter, pool)
+    finally:
+        for cam in cams:
+            cam.release()
+        if mqtt_publisher is not None:
+            mqtt_publisher.close()
+            print(mqtt_publisher.report())
+        if metrics_server is not None:
+            metrics_server.close()
 
 
 if __name__ == '__main__':
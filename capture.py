@@ -0,0 +1,70 @@
+"""capture
+
+This module reads a video stream in its own thread, so decoding runs beside the ml model.
+Only the newest frame is kept, older frames that were not taken in time are dropped and counted.
+"""
+import threading
+import cv2
+from absl import flags
+
+import metrics
+
+FLAGS = flags.FLAGS
+flags.DEFINE_boolean('threaded_capture', True, 'read the video stream in its own thread and keep the newest frame')
+
+
+class FrameGrabber:
+    """Drop in for cv2.VideoCapture, read() returns the newest frame and waits if it was already taken."""
+
+    def __init__(self, source, drop_frames=True, telemetry=None):
+        self.vid = cv2.VideoCapture(source)
+        self.vid.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        self.drop_frames = drop_frames  # False for video files, every frame is taken
+        self.cond = threading.Condition()
+        self.ret = True
+        self.frame = None
+        self.new_frame = False
+        self.running = True
+        self.frames_read = 0
+        self.dropped = 0
+        self.telemetry = telemetry  # time of each read of the stream
+
+        self.thread = threading.Thread(target=self.update, daemon=True)
+        self.thread.start()
+
+    def update(self):
+        while self.running:
+            with metrics.measure(self.telemetry, 'capture'):
+                ret, frame = self.vid.read()
+            with self.cond:
+                if not self.drop_frames:
+                    while self.new_frame and self.running:
+                        self.cond.wait()
+                if self.new_frame:
+                    self.dropped += 1
+                self.ret, self.frame = ret, frame
+                self.new_frame = True
+                if ret:
+                    self.frames_read += 1
+                self.cond.notify_all()
+            if not ret:
+                return
+
+    def read(self, timeout=None):
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.new_frame, timeout):
+                return False, None
+            self.new_frame = False
+            self.cond.notify_all()
+            return self.ret, self.frame
+
+    def release(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        # a stalled stream may block the read of the thread
+        self.thread.join(timeout=1)
+        self.vid.release()
+
+    def report(self):
+        return f"Capture: {self.frames_read} frames read, {self.dropped} dropped"
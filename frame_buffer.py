@@ -0,0 +1,77 @@
+"""frame buffer
+
+This module keeps a frame in the color order it was captured in. Other color orders, the resized input of the
+model and the image with the drawn boxes are only created if a consumer asks for them, and only once.
+Without a window and without a detection to publish no box is drawn and no color is converted.
+"""
+import threading
+import cv2
+
+_CONVERSIONS = {
+    ('BGR', 'RGB'): cv2.COLOR_BGR2RGB,
+    ('RGB', 'BGR'): cv2.COLOR_RGB2BGR,
+    ('BGR', 'GRAY'): cv2.COLOR_BGR2GRAY,
+    ('RGB', 'GRAY'): cv2.COLOR_RGB2GRAY,
+}
+
+
+def convert(image, from_order, to_order):
+    if from_order == to_order:
+        return image
+    return cv2.cvtColor(image, _CONVERSIONS[(from_order, to_order)])
+
+
+class FrameBuffer:
+    """A frame with its color order, views are converted on demand and kept for the other consumers."""
+
+    def __init__(self, image, order='BGR'):
+        self.image = image  # as captured, the boxes are drawn into it
+        self.order = order
+        self.views = {}
+        self.draw = None  # draws the boxes into an image of the given order, until it is needed
+        self.lock = threading.RLock()
+
+    @property
+    def shape(self):
+        return self.image.shape
+
+    def view(self, order):
+        with self.lock:
+            if order == self.order:
+                return self.image
+            if order not in self.views:
+                self.views[order] = convert(self.image, self.order, order)
+            return self.views[order]
+
+    # Input of the model, resized before the color is converted, so only the small image is converted
+    def resized(self, size, order='RGB'):
+        return self.region(0, 0, self.image.shape[1], self.image.shape[0], size, order)
+
+    def region(self, xmin, ymin, xmax, ymax, size, order='RGB'):
+        key = (xmin, ymin, xmax, ymax, size, order)
+        with self.lock:
+            if key not in self.views:
+                image = cv2.resize(self.image[ymin:ymax, xmin:xmax], (size, size))
+                self.views[key] = convert(image, self.order, order)
+            return self.views[key]
+
+    # The boxes are drawn once the annotated image is needed, e.g. by the window or the publisher
+    def annotate(self, draw):
+        with self.lock:
+            self.draw = draw
+
+    def annotated(self, order='BGR'):
+        with self.lock:
+            if self.draw is not None:
+                self.draw(self.image, self.order)
+                self.draw = None
+                # views of the frame before the boxes were drawn
+                self.views.clear()
+            return self.view(order)
+
+
+# Frames given as array are taken as RGB, as the model needs them
+def wrap(frame, order='RGB'):
+    if isinstance(frame, FrameBuffer):
+        return frame
+    return FrameBuffer(frame, order)
@@ -0,0 +1,176 @@
+"""golden
+
+This module checks that changes of the preprocessing, the decoder or the nms do not change the detections.
+The detections of a fixed clip are recorded once as golden output, in the yolo format of the test files
+with the score appended. Later runs are compared against it within a tolerance.
+With hand labeled ground truth in the same format (without the score) the mAP of the clip is reported.
+"""
+import os
+import sys
+import numpy as np
+from absl import app, flags
+
+import benchmark
+import frame_buffer
+import nms
+import utility
+import yolov4_tiny
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string('golden_clip', None, 'video or directory of images the detections are taken from')
+flags.DEFINE_string('golden_dir', './golden', 'directory of the golden output, one .txt per frame')
+flags.DEFINE_enum('golden_mode', 'check', ['record', 'check'], 'record the golden output or check against it')
+flags.DEFINE_float('golden_box_tol', 0.005, 'max difference of a box coordinate, relative to the image size')
+flags.DEFINE_float('golden_score_tol', 0.5, 'max difference of a score in percent')
+flags.DEFINE_string('golden_truth', None, 'directory of hand labeled ground truth .txt files, for the mAP')
+flags.DEFINE_float('golden_iou', 0.5, 'min overlap of a detection with the ground truth to count as found')
+
+
+# Detections of the clip frame by frame, the frame is prepared as in cam_local
+def detect_clip(interpreter, path):
+    for name, frame in benchmark.replay_frames(path):
+        frame = frame_buffer.FrameBuffer(frame, 'BGR')
+        image_data = frame.resized(FLAGS.input_size)
+        img_height, img_width = frame.shape[:2]
+        yield name, interpreter.predict(image_data, img_height, img_width), img_height, img_width
+
+
+# Labels, boxes as relative xmin, ymin, xmax, ymax and scores (None without scores) of a yolo .txt file
+def read_labels(path):
+    rows = []
+    if os.path.exists(path):
+        rows = [line.split() for line in utility.read_info(path).values() if line.strip()]
+    values = np.array(rows, dtype=np.float64) if rows else np.zeros((0, 5))
+    labels = values[:, 0].astype(np.int64)
+    centers, sizes = values[:, 1:3], values[:, 3:5]
+    boxes = np.concatenate((centers - sizes / 2, centers + sizes / 2), axis=1)
+    scores = values[:, 5] if values.shape[1] > 5 else None
+    return labels, boxes, scores
+
+
+def relative_boxes(detections, img_height, img_width):
+    return detections.boxes / np.array([img_width, img_height, img_width, img_height], dtype=np.float64)
+
+
+def record(interpreter):
+    os.makedirs(FLAGS.golden_dir, exist_ok=True)
+    frames = 0
+    for name, detections, img_height, img_width in detect_clip(interpreter, FLAGS.golden_clip):
+        with open(os.path.join(FLAGS.golden_dir, name + ".txt"), "w") as file:
+            file.write(detections.to_yolo(img_height, img_width, with_scores=True))
+        frames += 1
+    print(f"Golden output of {frames} frames recorded in {FLAGS.golden_dir}")
+
+
+# Differences of one frame, the detections are paired by label and the nearest box
+def compare_frame(golden, labels, boxes, scores):
+    golden_labels, golden_boxes, golden_scores = golden
+    problems = []
+    if len(golden_labels) != len(labels):
+        problems.append(f"{len(labels)} detections instead of {len(golden_labels)}")
+    box_diff = score_diff = 0.
+    used = set()
+    for i in range(len(golden_labels)):
+        candidates = [j for j in range(len(labels)) if labels[j] == golden_labels[i] and j not in used]
+        if not candidates:
+            problems.append(f"label {golden_labels[i]} missing")
+            continue
+        # the largest coordinate difference, also defined for boxes without area
+        j = min(candidates, key=lambda j: np.abs(golden_boxes[i] - boxes[j]).max())
+        used.add(j)
+        box_diff = max(box_diff, float(np.abs(golden_boxes[i] - boxes[j]).max()))
+        if golden_scores is not None:
+            score_diff = max(score_diff, abs(float(golden_scores[i]) - float(scores[j])))
+    if box_diff > FLAGS.golden_box_tol:
+        problems.append(f"box differs by {box_diff:.4f}")
+    if score_diff > FLAGS.golden_score_tol:
+        problems.append(f"score differs by {score_diff:.3f}")
+    return problems, box_diff, score_diff
+
+
+def check(interpreter):
+    frames = failed = 0
+    max_box = max_score = 0.
+    predictions = {}
+    for name, detections, img_height, img_width in detect_clip(interpreter, FLAGS.golden_clip):
+        boxes = relative_boxes(detections, img_height, img_width)
+        predictions[name] = (detections.labels, boxes, detections.scores)
+        path = os.path.join(FLAGS.golden_dir, name + ".txt")
+        if not os.path.exists(path):
+            raise ValueError(f"Error: no golden output for {name}, record it first")
+        problems, box_diff, score_diff = compare_frame(read_labels(path), detections.labels, boxes,
+                                                       detections.scores)
+        max_box, max_score = max(max_box, box_diff), max(max_score, score_diff)
+        frames += 1
+        if problems:
+            failed += 1
+            print(f"{name}: " + ", ".join(problems))
+    print(f"Golden check: {frames - failed} of {frames} frames match, max box difference {max_box:.4f}, "
+          f"max score difference {max_score:.3f}")
+    if FLAGS.golden_truth is not None:
+        mean_average_precision(predictions, FLAGS.golden_truth)
+    if failed:
+        raise ValueError(f"Error: {failed} of {frames} frames differ from the golden output")
+
+
+# Area under the precision recall curve, with the precision made monotonic as for pascal voc
+def average_precision(true_positive, num_truth):
+    true_positive = np.asarray(true_positive, dtype=np.float64)
+    tp = np.cumsum(true_positive)
+    fp = np.cumsum(1 - true_positive)
+    recall = np.concatenate(([0.], tp / num_truth, [1.]))
+    precision = np.concatenate(([0.], tp / np.maximum(tp + fp, 1e-9), [0.]))
+    precision = np.maximum.accumulate(precision[::-1])[::-1]
+    changes = np.flatnonzero(recall[1:] != recall[:-1])
+    return float(np.sum((recall[changes + 1] - recall[changes]) * precision[changes + 1]))
+
+
+def mean_average_precision(predictions, truth_dir):
+    truth = {name: read_labels(os.path.join(truth_dir, name + ".txt")) for name in predictions}
+    classes = yolov4_tiny.ObjectsHandler().classes
+    average_precisions = {}
+    for class_ind in sorted({int(label) for labels, _, _ in truth.values() for label in labels}):
+        num_truth = 0
+        ranked = []  # score, frame, box of every detection of the class
+        for name, (labels, boxes, scores) in predictions.items():
+            num_truth += int(np.count_nonzero(truth[name][0] == class_ind))
+            ranked += [(score, name, box) for label, box, score in zip(labels, boxes, scores) if label == class_ind]
+        ranked.sort(key=lambda item: -item[0])
+        found = {name: set() for name in predictions}
+        true_positive = []
+        for _, name, box in ranked:
+            truth_labels, truth_boxes, _ = truth[name]
+            index = np.flatnonzero(truth_labels == class_ind)
+            hit = False
+            if len(index):
+                iou = nms.iou_matrix(box[np.newaxis], truth_boxes[index])[0]
+                best = int(np.argmax(iou))
+                if iou[best] >= FLAGS.golden_iou and index[best] not in found[name]:
+                    found[name].add(index[best])
+                    hit = True
+            true_positive.append(hit)
+        average_precisions[class_ind] = average_precision(true_positive, num_truth)
+        print(f"AP {classes.get(class_ind, class_ind)}: {average_precisions[class_ind]:.4f} ({num_truth} labeled)")
+    if average_precisions:
+        print(f"mAP@{FLAGS.golden_iou}: {np.mean(list(average_precisions.values())):.4f}")
+    return average_precisions
+
+
+def main(_argv):
+    if FLAGS.golden_clip is None:
+        raise ValueError("Error: golden_clip is needed")
+    interpreter = yolov4_tiny.TfLiteInterpreter()
+    if FLAGS.golden_mode == 'record':
+        record(interpreter)
+    else:
+        check(interpreter)
+
+
+if __name__ == '__main__':
+    FLAGS(sys.argv)
+    try:
+        app.run(main)
+    except SystemExit:
+        pass
+else:
+    pass
@@ -0,0 +1,167 @@
+"""metrics
+
+This module measures the time spent in each stage of a frame, e.g. capture, resize, invoke, decode, nms, draw,
+encode and publish. The last durations of each stage are kept in a rolling window, so the statistic follows
+changes of the load. Each camera has its own Telemetry, it can be published by mqtt or scraped as plain text.
+"""
+import collections
+import contextlib
+import http.server
+import json
+import threading
+import time
+import numpy as np
+from absl import flags
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('telemetry_window', 512, 'amount of the last durations of each stage kept for the statistic')
+flags.DEFINE_integer('stats_interval', 30, 'seconds between two stats messages of a camera, 0 to disable')
+flags.DEFINE_integer('metrics_port', None, 'port of the plain text metrics endpoint, disabled if None')
+
+STAGES = ('capture', 'resize', 'invoke', 'decode', 'nms', 'draw', 'encode', 'publish', 'frame')
+
+
+class Telemetry:
+    """Rolling durations of the stages and the times the frames were finished, safe to use from several threads."""
+
+    def __init__(self, name, window=None):
+        if window is None:
+            window = FLAGS.telemetry_window
+        self.name = name
+        self.window = window
+        self.lock = threading.Lock()
+        self.durations = {}
+        self.counts = collections.Counter()
+        self.frame_times = collections.deque(maxlen=window)
+        # time between two frames that both were run through the model, a pause of the motion gate is left out
+        self.model_intervals = collections.deque(maxlen=window)
+        self.last_skipped = False
+        self.last_report = time.time()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            durations = self.durations.get(stage)
+            if durations is None:
+                durations = self.durations[stage] = collections.deque(maxlen=self.window)
+            durations.append(seconds)
+            self.counts[stage] += 1
+
+    # Called once a frame is finished, the frames per second are taken from these times
+    def frame_done(self, skipped=False):
+        now = time.perf_counter()
+        with self.lock:
+            if self.frame_times:
+                durations = self.durations.setdefault('frame', collections.deque(maxlen=self.window))
+                durations.append(now - self.frame_times[-1])
+                self.counts['frame'] += 1
+                if not skipped and not self.last_skipped:
+                    self.model_intervals.append(now - self.frame_times[-1])
+            self.frame_times.append(now)
+            self.last_skipped = skipped
+
+    def frames(self):
+        with self.lock:
+            return len(self.frame_times)
+
+    def fps(self):
+        with self.lock:
+            return self._rate(self.frame_times)
+
+    # Frames per second run through the model, without the frames skipped by the motion gate
+    def model_fps(self):
+        with self.lock:
+            total = sum(self.model_intervals)
+            return len(self.model_intervals) / total if total > 0 else 0.
+
+    @staticmethod
+    def _rate(times):
+        if len(times) < 2:
+            return 0.
+        span = times[-1] - times[0]
+        return (len(times) - 1) / span if span > 0 else 0.
+
+    # Count, mean and percentiles in ms of every stage measured so far
+    def summary(self):
+        with self.lock:
+            durations = {stage: np.array(values) * 1000 for stage, values in self.durations.items() if values}
+            counts = dict(self.counts)
+        summary = {}
+        for stage in sorted(durations, key=lambda stage: STAGES.index(stage) if stage in STAGES else len(STAGES)):
+            values = durations[stage]
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            summary[stage] = {'count': counts[stage], 'mean': float(values.mean()), 'p50': float(p50),
+                              'p95': float(p95), 'p99': float(p99)}
+        return summary
+
+    # Short json for the mqtt stats message, ms rounded to 0.1
+    def compact(self):
+        stages = {stage: [round(st['p50'], 1), round(st['p95'], 1), round(st['p99'], 1)]
+                  for stage, st in self.summary().items()}
+        return json.dumps({'fps': round(self.fps(), 1), 'model_fps': round(self.model_fps(), 1), 'ms': stages},
+                          separators=(',', ':'))
+
+    # True once every interval, used to publish the stats periodically
+    def report_due(self, interval=None):
+        if interval is None:
+            interval = FLAGS.stats_interval
+        if not interval:
+            return False
+        now = time.time()
+        if now - self.last_report < interval:
+            return False
+        self.last_report = now
+        return True
+
+    def text(self):
+        lines = [f'smartcam_fps{{cam="{self.name}"}} {self.fps():.3f}',
+                 f'smartcam_model_fps{{cam="{self.name}"}} {self.model_fps():.3f}']
+        for stage, st in self.summary().items():
+            labels = f'cam="{self.name}",stage="{stage}"'
+            lines.append(f'smartcam_stage_count{{{labels}}} {st["count"]}')
+            lines.append(f'smartcam_stage_ms_mean{{{labels}}} {st["mean"]:.3f}')
+            for quantile in ('p50', 'p95', 'p99'):
+                lines.append(f'smartcam_stage_ms{{{labels},quantile="0.{quantile[1:]}"}} {st[quantile]:.3f}')
+        return "\n".join(lines) + "\n"
+
+
+# Measures the time of the with block as the stage, nothing is measured without telemetry
+@contextlib.contextmanager
+def measure(telemetry, stage):
+    if telemetry is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        telemetry.add(stage, time.perf_counter() - start)
+
+
+class MetricsServer:
+    """Plain text endpoint with the metrics of all telemetries, served in its own thread."""
+
+    def __init__(self, telemetries, port=None):
+        if port is None:
+            port = FLAGS.metrics_port
+        self.telemetries = telemetries
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = "".join(telemetry.text() for telemetry in server.telemetries).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(("", port), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
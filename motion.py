@@ -0,0 +1,119 @@
+"""motion
+
+This module checks the frames for motion, so the ml model only has to run if something in the scene changes.
+The frame is downscaled, converted to grayscale and compared to a slowly adapting background.
+"""
+import time
+import cv2
+import numpy as np
+from absl import flags
+
+FLAGS = flags.FLAGS
+flags.DEFINE_boolean('motion_gate', False, 'skip the ml model on frames without motion')
+flags.DEFINE_integer('motion_width', 160, 'width of the downscaled frame used for the motion check')
+flags.DEFINE_integer('motion_pixel_thresh', 25, 'min difference of a pixel to the background to count as motion')
+flags.DEFINE_float('motion_sensitivity', 0.005, 'min ratio of changed pixels for a frame with motion')
+flags.DEFINE_float('motion_learning_rate', 0.05, 'how fast the background adapts to changes of the scene')
+flags.DEFINE_string('motion_mask', None, 'path to an image, black areas are ignored for the motion check')
+flags.DEFINE_integer('motion_hold', 5, 'frames the model keeps running after the last motion')
+flags.DEFINE_integer('motion_report_frames', 1000, 'print the statistic of the gate every x frames, 0 to disable')
+flags.DEFINE_boolean('motion_tiles', True, 'with tiled inference only run the tiles with motion')
+
+
+class MotionGate:
+    def __init__(self, mask_file=None):
+        if mask_file is None:
+            mask_file = FLAGS.motion_mask
+        self.mask_file = mask_file
+        self.mask = None
+        self.background = None
+        self.changed = None  # pixels with motion of the last checked frame, downscaled
+        self.moving = False  # last checked frame had motion itself, not only by the hold
+        self.hold = 0
+
+        self.frames = 0
+        self.skipped = 0
+        # cpu time of the thread doing the work, time.thread_time, so the capture and other threads do not count
+        # the threads started by tflite or opencv themselves are not included either
+        self.check_time = 0.  # cpu time spent for the motion checks
+        self.infer_time = 0.  # cpu time of the model and the object handling of the frames run through the model
+        self.infer_frames = 0
+
+    # The small image is converted to grayscale, not the whole frame
+    def _downscale(self, frame, order='RGB'):
+        height, width = frame.shape[:2]
+        size = (FLAGS.motion_width, max(int(height * FLAGS.motion_width / width), 1))
+        small = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY if order == 'BGR' else cv2.COLOR_RGB2GRAY)
+        return cv2.GaussianBlur(small, (5, 5), 0)
+
+    def _load_mask(self, shape):
+        mask = cv2.imread(self.mask_file, cv2.IMREAD_GRAYSCALE)
+        if mask is None:
+            raise ValueError(f"Error: motion mask {self.mask_file} not readable")
+        self.mask = cv2.resize(mask, (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST) > 0
+
+    # True if the frame has to run through the model, order is the color order of a frame with colors
+    def check(self, frame, order='RGB'):
+        start = time.thread_time()
+        self.frames += 1
+        small = self._downscale(frame, order)
+        if self.background is None:
+            if self.mask_file is not None:
+                self._load_mask(small.shape)
+            self.background = small.astype(np.float32)
+            self.changed = np.ones(small.shape, dtype=bool)
+            self.moving = True
+            self.hold = FLAGS.motion_hold
+            self.check_time += time.thread_time() - start
+            return True
+
+        self.changed = cv2.absdiff(small, cv2.convertScaleAbs(self.background)) > FLAGS.motion_pixel_thresh
+        if self.mask is not None:
+            self.changed &= self.mask
+            area = np.count_nonzero(self.mask)
+        else:
+            area = self.changed.size
+        cv2.accumulateWeighted(small, self.background, FLAGS.motion_learning_rate)
+
+        self.moving = np.count_nonzero(self.changed) > FLAGS.motion_sensitivity * area
+        if self.moving:
+            self.hold = FLAGS.motion_hold
+            motion = True
+        elif self.hold > 0:
+            self.hold -= 1
+            motion = True
+        else:
+            self.skipped += 1
+            motion = False
+        self.check_time += time.thread_time() - start
+        if FLAGS.motion_report_frames and self.frames % FLAGS.motion_report_frames == 0:
+            print(self.report())
+        return motion
+
+    # Motion inside a rectangle given in coordinates of the full frame
+    def region_has_motion(self, xmin, ymin, xmax, ymax, frame_shape):
+        scale_y = self.changed.shape[0] / frame_shape[0]
+        scale_x = self.changed.shape[1] / frame_shape[1]
+        region = self.changed[int(ymin * scale_y):int(np.ceil(ymax * scale_y)),
+                              int(xmin * scale_x):int(np.ceil(xmax * scale_x))]
+        return np.count_nonzero(region) > FLAGS.motion_sensitivity * max(region.size, 1)
+
+    # Regions to run through the model, all of them while the model only runs because of the hold
+    def regions_with_motion(self, regions, frame_shape):
+        if not FLAGS.motion_tiles or not self.moving:
+            return regions
+        return [region for region in regions if self.region_has_motion(*region, frame_shape)]
+
+    def add_inference_time(self, cpu_time):
+        self.infer_time += cpu_time
+        self.infer_frames += 1
+
+    def report(self):
+        if self.infer_frames:
+            saved = self.skipped * self.infer_time / self.infer_frames - self.check_time
+        else:
+            saved = 0.
+        return (f"Motion gate: {self.skipped} of {self.frames} frames skipped, "
+                f"about {max(saved, 0.):.1f} s cpu time saved")
@@ -0,0 +1,58 @@
+"""nms
+
+This module includes the non maximum suppression of the detected boxes.
+Boxes are arrays of shape (N, 4) with xmin, ymin, xmax, ymax, scores are matrices of shape (N, classes).
+"""
+import numpy as np
+
+
+def iou_matrix(boxes_a, boxes_b=None):
+    """Intersection over union of every box in boxes_a with every box in boxes_b, shape (N, M)."""
+    if boxes_b is None:
+        boxes_b = boxes_a
+    boxes_a = np.asarray(boxes_a, dtype=np.float64)
+    boxes_b = np.asarray(boxes_b, dtype=np.float64)
+    top_left = np.maximum(boxes_a[:, np.newaxis, :2], boxes_b[np.newaxis, :, :2])
+    bottom_right = np.minimum(boxes_a[:, np.newaxis, 2:], boxes_b[np.newaxis, :, 2:])
+    intersect = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area_a = np.prod(boxes_a[:, 2:] - boxes_a[:, :2], axis=1)
+    area_b = np.prod(boxes_b[:, 2:] - boxes_b[:, :2], axis=1)
+    union = area_a[:, np.newaxis] + area_b[np.newaxis, :] - intersect
+    # boxes without any area do not overlap anything
+    return np.divide(intersect, union, out=np.zeros_like(intersect), where=union > 0)
+
+
+def _suppress(order, iou, nms_thresh):
+    """Greedy suppression along order (highest score first), returns the indices to suppress."""
+    suppressed = []
+    while order.size > 1:
+        overlap = iou[order[0], order[1:]] >= nms_thresh
+        suppressed.append(order[1:][overlap])
+        order = order[1:][~overlap]
+    if suppressed:
+        return np.concatenate(suppressed)
+    return np.empty(0, dtype=np.intp)
+
+
+def non_max_suppression(boxes, scores, nms_thresh, class_agnostic=False):
+    """Suppresses overlapping boxes by setting their scores to zero in place.
+
+    Class aware, every class is suppressed on its own and a box only suppresses boxes of the same class.
+    Class agnostic, a box is ranked by its best class and suppresses all classes of the overlapped boxes.
+    """
+    if len(boxes) == 0:
+        return scores
+    iou = iou_matrix(boxes)
+    if class_agnostic:
+        best = scores.max(axis=1)
+        order = np.flatnonzero(best)
+        order = order[np.argsort(-best[order], kind='stable')]
+        scores[_suppress(order, iou, nms_thresh)] = 0
+        return scores
+
+    # only classes with at least one candidate need to be checked
+    for c in np.flatnonzero(scores.any(axis=0)):
+        order = np.flatnonzero(scores[:, c])
+        order = order[np.argsort(-scores[order, c], kind='stable')]
+        scores[_suppress(order, iou, nms_thresh), c] = 0
+    return scores
@@ -0,0 +1,154 @@
+"""pipeline
+
+This module splits the work on a frame into stages, each running in its own thread.
+The stages are connected by bounded queues. If a stage falls behind, its queue is full and
+the drop policy decides whether the oldest or the newest item is dropped or the previous stage has to wait.
+"""
+import queue
+import threading
+import time
+from absl import flags
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('pipeline_queue_size', 2, 'max amount of items waiting in front of each stage')
+flags.DEFINE_enum('pipeline_drop_policy', 'drop_oldest', ['drop_oldest', 'drop_newest', 'block'],
+                  'what happens if the queue of a stage is full')
+
+_STOP = object()
+
+
+class Stage:
+    """Runs func on every item of its queue and hands the result to the next stage.
+
+    Without func the stage is only a queue, e.g. for the main thread that displays the frames.
+    A result of None is not handed on.
+    """
+
+    def __init__(self, name, func=None, maxsize=None, drop_policy=None, workers=1):
+        if maxsize is None:
+            maxsize = FLAGS.pipeline_queue_size
+        if drop_policy is None:
+            drop_policy = FLAGS.pipeline_drop_policy
+        self.name = name
+        self.func = func
+        self.drop_policy = drop_policy
+        self.queue = queue.Queue(maxsize)
+        self.next = None
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0  # items func raised an error for
+        self.blocked = 0  # items that had to wait for a free place with the block policy
+        self.service_time = 0.
+        self.max_depth = 0
+        self.threads = []
+        if func is not None:
+            self.threads = [threading.Thread(target=self.run, name=f"{name}_{i}", daemon=True)
+                            for i in range(workers)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, item):
+        if self.drop_policy == 'block':
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                with self.lock:
+                    self.blocked += 1
+                self.queue.put(item)
+        elif self.drop_policy == 'drop_newest':
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                self._count_drop()
+        else:
+            while True:
+                try:
+                    self.queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        self.queue.get_nowait()
+                        self._count_drop()
+                    except queue.Empty:
+                        pass
+        with self.lock:
+            self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def _count_drop(self):
+        with self.lock:
+            self.dropped += 1
+
+    def get(self, timeout=None):
+        return self.queue.get(timeout=timeout)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                return
+            start = time.perf_counter()
+            try:
+                result = self.func(item)
+            except Exception as e:
+                # a failing item must not end the stage, the following items are still taken
+                print(f"Error: stage {self.name} failed: {e!r}")
+                with self.lock:
+                    self.failed += 1
+                continue
+            with self.lock:
+                self.service_time += time.perf_counter() - start
+                self.processed += 1
+            if result is not None and self.next is not None:
+                self.next.put(result)
+
+    def stop(self):
+        for thread in self.threads:
+            # the stop item must not be dropped, but a thread that already ended does not empty the queue
+            while thread.is_alive():
+                try:
+                    self.queue.put(_STOP, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+        for thread in self.threads:
+            thread.join()
+
+    def stats(self):
+        with self.lock:
+            service_ms = self.service_time / self.processed * 1000 if self.processed else 0.
+            return {'name': self.name, 'depth': self.queue.qsize(), 'max_depth': self.max_depth,
+                    'processed': self.processed, 'dropped': self.dropped, 'failed': self.failed,
+                    'blocked': self.blocked, 'service_ms': service_ms}
+
+
+class Pipeline:
+    """Stages connected in the given order, items put into the pipeline go to the first stage."""
+
+    def __init__(self, stages):
+        self.stages = stages
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next = next_stage
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def put(self, item):
+        self.stages[0].put(item)
+
+    def stop(self):
+        for stage in self.stages:
+            stage.stop()
+
+    def report(self):
+        return "Pipeline: " + report(self.stages)
+
+
+# Depth, service time and overflow of each stage in one line
+def report(stages):
+    return ", ".join(f"{st['name']} depth {st['depth']}/{st['max_depth']} {st['service_ms']:.1f} ms "
+                     f"{st['processed']} done {st['dropped']} dropped {st['failed']} failed {st['blocked']} blocked"
+                     for st in (stage.stats() for stage in stages))
@@ -0,0 +1,72 @@
+"""publisher
+
+This module encodes and publishes the detection events in its own thread, so the model does not wait for
+the jpg encoding and the mqtt messages. The events wait in a bounded queue, if the broker is too slow
+events are dropped by the drop policy. The queue is emptied before the publisher is closed.
+"""
+import threading
+import time
+from absl import flags
+
+import pipeline
+
+FLAGS = flags.FLAGS
+flags.DEFINE_boolean('async_publish', True, 'encode and publish the detections in an own thread')
+flags.DEFINE_integer('publish_queue_size', 16, 'max amount of detections waiting to be published')
+flags.DEFINE_enum('publish_drop_policy', 'drop_oldest', ['drop_oldest', 'drop_newest', 'block'],
+                  'what happens if the queue of the publisher is full')
+
+
+class Publisher:
+    """Publishes the detection events put into it, events of all cameras share the thread."""
+
+    def __init__(self, maxsize=None, drop_policy=None):
+        if maxsize is None:
+            maxsize = FLAGS.publish_queue_size
+        if drop_policy is None:
+            drop_policy = FLAGS.publish_drop_policy
+        self.stage = pipeline.Stage("publish", self.publish, maxsize=maxsize, drop_policy=drop_policy)
+        self.lock = threading.Lock()
+        self.published = 0
+        self.encode_time = 0.
+        self.publish_time = 0.
+        self.latency = 0.  # time from putting the event into the queue till it is published
+        self.latency_max = 0.
+        self.stage.start()
+
+    def put(self, event):
+        event.queued = time.perf_counter()
+        self.stage.put(event)
+
+    def publish(self, event):
+        start = time.perf_counter()
+        image = event.encode()
+        encoded = time.perf_counter()
+        event.publish(image)
+        end = time.perf_counter()
+        with self.lock:
+            self.published += 1
+            self.encode_time += encoded - start
+            self.publish_time += end - encoded
+            self.latency += end - event.queued
+            self.latency_max = max(self.latency_max, end - event.queued)
+
+    # Publishes the events still waiting and stops the thread
+    def close(self):
+        self.stage.stop()
+
+    def stats(self):
+        stage = self.stage.stats()
+        with self.lock:
+            count = max(self.published, 1)
+            return {'depth': stage['depth'], 'max_depth': stage['max_depth'], 'published': self.published,
+                    'dropped': stage['dropped'], 'failed': stage['failed'],
+                    'encode_ms': self.encode_time / count * 1000, 'publish_ms': self.publish_time / count * 1000,
+                    'latency_ms': self.latency / count * 1000, 'latency_max_ms': self.latency_max * 1000}
+
+    def report(self):
+        st = self.stats()
+        return (f"Publisher: depth {st['depth']}/{st['max_depth']}, {st['published']} published, "
+                f"{st['dropped']} dropped, {st['failed']} failed, "
+                f"encode {st['encode_ms']:.1f} ms, publish {st['publish_ms']:.1f} ms, "
+                f"latency {st['latency_ms']:.1f} ms (max {st['latency_max_ms']:.1f} ms)")
@@ -0,0 +1,60 @@
+"""router
+
+This module hands mqtt messages to the handler of their topic. The topic filters are split into a tree of
+levels once when they are added, a topic is then matched level by level instead of trying one pattern after
+another. Filters use the wildcards of mqtt, + for one level and # for all remaining levels.
+"""
+
+
+class _Node:
+    def __init__(self):
+        self.children = {}  # key is the level, + or #
+        self.handlers = []
+
+
+class TopicRouter:
+    """Handlers of mqtt topic filters, the levels matched by the wildcards are handed to the handler.
+
+    A handler is called as handler(client, userdata, msg, *levels) with a level for each + of its filter
+    and the remaining topic for a #.
+    """
+
+    def __init__(self):
+        self.root = _Node()
+
+    def add(self, topic_filter, handler):
+        levels = topic_filter.split('/')
+        if '#' in levels[:-1]:
+            raise ValueError(f"Error: # has to be the last level of {topic_filter}")
+        node = self.root
+        for level in levels:
+            node = node.children.setdefault(level, _Node())
+        node.handlers.append(handler)
+
+    # Handlers matching the topic, each with the levels of its wildcards
+    def match(self, topic):
+        matches = []
+        self._match(self.root, topic.split('/'), 0, [], matches)
+        return matches
+
+    def _match(self, node, levels, i, wildcards, matches):
+        rest = node.children.get('#')
+        if rest is not None:
+            # also matches the parent level itself, as a/# matches a
+            matches += [(handler, wildcards + ['/'.join(levels[i:])]) for handler in rest.handlers]
+        if i == len(levels):
+            matches += [(handler, wildcards) for handler in node.handlers]
+            return
+        child = node.children.get(levels[i])
+        if child is not None:
+            self._match(child, levels, i + 1, wildcards, matches)
+        child = node.children.get('+')
+        if child is not None:
+            self._match(child, levels, i + 1, wildcards + [levels[i]], matches)
+
+    # Used as on_message of the client, messages without a handler are ignored
+    def dispatch(self, client, userdata, msg):
+        matches = self.match(msg.topic)
+        for handler, wildcards in matches:
+            handler(client, userdata, msg, *wildcards)
+        return bool(matches)
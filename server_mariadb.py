@@ -4,6 +4,11 @@ This module handles all the local storing in the database. It will connect as a
 A connection to django is also created for transmitting the image.
 It will also send the notification of a detection.
 """
+import contextlib
+import heapq
+import json
+import queue
+import threading
 import sys
 import time
 import paho.mqtt.client as mqtt
@@ -15,6 +20,9 @@ import numpy as np
 import os
 
 
+import metrics
+import pipeline
+import router
 import utility
 
 FLAGS = flags.FLAGS
@@ -23,6 +31,17 @@ flags.DEFINE_string('det_table', 'detections', 'name of the table containing all
 
 flags.DEFINE_string('image_path', './images', 'path where to store detection images')
 flags.DEFINE_string('mariadb_config', './data/mariadb_config.json', 'file path to the mariadb login data')
+flags.DEFINE_integer('db_batch_size', 50, 'detection rows inserted together in one transaction')
+flags.DEFINE_float('db_batch_interval', 1., 'max seconds a detection row waits before it is inserted')
+flags.DEFINE_string('db_journal', './data/detections.journal', 'file of the detection rows not yet inserted')
+flags.DEFINE_integer('server_db_workers', 1, 'threads writing to the database, more may reorder the status of a cam')
+flags.DEFINE_integer('server_image_workers', 2, 'threads decoding and storing the detection images')
+flags.DEFINE_integer('server_notify_workers', 1, 'threads sending the notifications')
+flags.DEFINE_integer('server_queue_size', 64, 'max amount of messages waiting for each pool of workers')
+flags.DEFINE_enum('server_drop_policy', 'block', ['drop_oldest', 'drop_newest', 'block'],
+                  'what happens if the queue of the database or image workers is full, block holds back mqtt')
+flags.DEFINE_enum('server_notify_drop_policy', 'drop_newest', ['drop_oldest', 'drop_newest', 'block'],
+                  'what happens if the queue of the notification workers is full')
 
 
 class Mqtt:
@@ -32,119 +51,428 @@ class Mqtt:
         self.broker_adr = mqtt_adr
         self.name = "server"
         self.db = Database()
+        if FLAGS.metrics_port is not None:
+            # pool wait and query latency as plain text
+            metrics.MetricsServer([self.db.telemetry])
         self.client = mqtt.Client(self.name)
         self.client.connect(mqtt_adr)
+        self.workers = self.start_workers()
         self.assign_cams()
         self.client.loop_start()
-        while True:
-            time.sleep(7)
+        try:
+            while True:
+                time.sleep(7)
+                if self.db.telemetry.report_due():
+                    print(self.db.report())
+                    print("Workers: " + pipeline.report(self.workers.values()))
+        finally:
+            # the messages and detections still waiting are handled before the server stops
+            self.client.loop_stop()
+            for kind in ('db', 'image', 'notify'):
+                self.workers[kind].stop()
+            self.db.close()
+
+    # The mqtt thread only puts the messages into the queue of their pool, so a slow database, disk or mail
+    # server does not hold back the other messages and the keepalive
+    @staticmethod
+    def start_workers():
+        workers = {
+            'db': pipeline.Stage("db", Mqtt.run_job, maxsize=FLAGS.server_queue_size,
+                                 drop_policy=FLAGS.server_drop_policy, workers=FLAGS.server_db_workers),
+            'image': pipeline.Stage("image", Mqtt.run_job, maxsize=FLAGS.server_queue_size,
+                                    drop_policy=FLAGS.server_drop_policy, workers=FLAGS.server_image_workers),
+            'notify': pipeline.Stage("notify", Mqtt.run_job, maxsize=FLAGS.server_queue_size,
+                                     drop_policy=FLAGS.server_notify_drop_policy, workers=FLAGS.server_notify_workers),
+        }
+        for stage in workers.values():
+            stage.start()
+        return workers
+
+    # A failing message must not end the worker
+    @staticmethod
+    def run_job(job):
+        handler, args = job
+        try:
+            handler(*args)
+        except Exception as e:
+            print(f"Error: {handler.__name__} failed: {e}")
+
+    # Handler for the router, that puts the message into the queue of the pool
+    def queued(self, kind, handler):
+        def put(*args):
+            self.workers[kind].put((handler, args))
+        return put
 
     def assign_cams(self):
+        setup = self.mqtt_topics['device_cfg']['root']
+        device = self.mqtt_topics['device_root']
 
-        def on_message(client, userdata, msg):
-
-            m = utility.REMatcher(msg.topic)
-
-            # Register a camera by finding a free id
-            if msg.topic == f"{self.mqtt_topics['device_cfg']['root']}/{self.mqtt_topics['device_cfg']['request_id']}":
-                message = msg.payload.decode().split('<:>')
-                ids_occupied = self.db.get_column("id", FLAGS.cam_table, orderc="id")
-                new_id = 0
-                for cam_id in ids_occupied:
-                    if new_id != cam_id:
-                        break
-                    else:
-                        new_id = new_id + 1
-                self.db.insert_item([new_id, None, 0], FLAGS.cam_table)
-                client.publish(f"{self.mqtt_topics['device_cfg']['root']}/{self.mqtt_topics['device_cfg']['set_id']}",
-                               f"{utility.get_datetime()}<:>{client}<:>{message[1]},{new_id}")
-
-            # Receive the additional information after registration
-            elif msg.topic == f"{self.mqtt_topics['device_cfg']['root']}/{self.mqtt_topics['device_cfg']['register']}":
-                message = msg.payload.decode().split('<:>')
-                self.db.update_all_items(message, message[1], "id", FLAGS.cam_table)
-
-            # Change the device status of a camera
-            elif m.match(rf"^{self.mqtt_topics['device_root']}/([^\s]+)/{self.mqtt_topics['device_status']}"):
-                message = msg.payload.decode().split('<:>')
-                self.db.update_item("status", (message[2], m.group(1)), "id", FLAGS.cam_table)
-                self.db.update_item("uptime", (message[0], m.group(1)), "id", FLAGS.cam_table)
-
-            # Receive the information of a detection
-            elif m.match(rf"^{self.mqtt_topics['device_root']}/([^\s]+)/{self.mqtt_topics['detection_info']}/([^\s]+)"):
-                message = msg.payload.decode().split('<:>')
-                img_path_rel = FLAGS.image_path + "/" + message[2]
-                img_path_abs = os.path.abspath(img_path_rel)
-
-                ids_occupied = self.db.get_column("id", FLAGS.det_table, orderc="id")
-                new_id = 0
-                for cam_id in ids_occupied:
-                    if new_id != cam_id:
-                        break
-                    else:
-                        new_id = new_id + 1
-                item = [new_id, m.group(2), message[0], message[1], message[3], img_path_abs, m.group(1)]
-                self.db.insert_item(item, FLAGS.det_table)
-                print(msg.topic, message)
-
-            # Receive the image of a detection and send notification
-            elif m.match(rf"^{self.mqtt_topics['device_root']}/([^\s]+)/{self.mqtt_topics['image']}/([^\s]+)"):
-                nparr = np.frombuffer(msg.payload, np.uint8)
-                img_decode = cv2.imdecode(nparr, cv2.IMREAD_UNCHANGED)
-                path = f"{FLAGS.image_path}/{m.group(2)}"
-                cv2.imwrite(path, img_decode)
-                utility.send_notification(m.group(2))
-
-        self.client.subscribe(f"{self.mqtt_topics['device_cfg']['root']}/#")
-        self.client.subscribe(f"{self.mqtt_topics['device_root']}/#")
-        self.client.on_message = on_message
+        # Register a camera by finding a free id
+        def on_request_id(client, userdata, msg):
+            message = msg.payload.decode().split('<:>')
+            new_id = self.db.insert_cam()
+            if new_id is None:
+                # the camera asks again after its retry time
+                return
+            client.publish(f"{setup}/{self.mqtt_topics['device_cfg']['set_id']}",
+                           f"{utility.get_datetime()}<:>{client}<:>{message[1]},{new_id}")
 
+        # Receive the additional information after registration
+        def on_register(client, userdata, msg):
+            message = msg.payload.decode().split('<:>')
+            self.db.update_all_items(message, message[1], "id", FLAGS.cam_table)
 
-class Database:
-    @staticmethod
-    def connect_mariadb():
-        data = utility.read_json(FLAGS.mariadb_config)
+        # Change the device status of a camera
+        def on_status(client, userdata, msg, cam_id):
+            message = msg.payload.decode().split('<:>')
+            self.db.update_item("status", (message[2], cam_id), "id", FLAGS.cam_table)
+            self.db.update_item("uptime", (message[0], cam_id), "id", FLAGS.cam_table)
+
+        # Receive the information of a detection
+        def on_detection(client, userdata, msg, cam_id, name):
+            message = msg.payload.decode().split('<:>')
+            img_path_rel = FLAGS.image_path + "/" + message[2]
+            img_path_abs = os.path.abspath(img_path_rel)
+
+            # the id is given by auto increment when the row is inserted
+            item = [name, message[0], message[1], message[3], img_path_abs, cam_id]
+            self.db.insert_item(item, FLAGS.det_table)
+            print(msg.topic, message)
+
+        # Receive the image of a detection and send notification
+        def on_image(client, userdata, msg, cam_id, img_name):
+            nparr = np.frombuffer(msg.payload, np.uint8)
+            img_decode = cv2.imdecode(nparr, cv2.IMREAD_UNCHANGED)
+            path = f"{FLAGS.image_path}/{img_name}"
+            cv2.imwrite(path, img_decode)
+            # sent once the image is stored
+            self.workers['notify'].put((utility.send_notification, (img_name,)))
+
+        # the topics are built once, each message is matched level by level
+        topics = router.TopicRouter()
+        topics.add(f"{setup}/{self.mqtt_topics['device_cfg']['request_id']}", self.queued('db', on_request_id))
+        topics.add(f"{setup}/{self.mqtt_topics['device_cfg']['register']}", self.queued('db', on_register))
+        topics.add(f"{device}/+/{self.mqtt_topics['device_status']}", self.queued('db', on_status))
+        topics.add(f"{device}/+/{self.mqtt_topics['detection_info']}/+", self.queued('db', on_detection))
+        topics.add(f"{device}/+/{self.mqtt_topics['image']}/+", self.queued('image', on_image))
+
+        # paho hands the messages of each subscription straight to the router
+        for subscription in (f"{setup}/#", f"{device}/#"):
+            self.client.message_callback_add(subscription, topics.dispatch)
+            self.client.subscribe(subscription)
+
+
+class PooledConnection:
+    """A connection of the pool with a prepared cursor for each statement run on it."""
+
+    def __init__(self, params):
+        self.params = params
+        self.conn = None
+        self.cursors = {}
+
+    def connect(self):
+        self.close()
+        self.conn = mariadb.connect(**self.params)
+
+    # The statement is prepared by the server on the first execute of its cursor, later calls only send the values
+    def cursor(self, sql):
+        cur = self.cursors.get(sql)
+        if cur is None:
+            cur = self.cursors[sql] = self.conn.cursor(prepared=True)
+        return cur
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except mariadb.Error:
+                pass
+        self.conn = None
+        self.cursors = {}
+
+
+class ConnectionPool:
+    """Connections to mariadb kept open and shared by the threads of the server.
+
+    The size and the wait timeout are read from the mariadb config, pool_size and pool_timeout.
+    A lost connection is opened again and the statement is run once more.
+    """
+
+    def __init__(self, config_file=None, telemetry=None):
+        if config_file is None:
+            config_file = FLAGS.mariadb_config
+        data = utility.read_json(config_file)
+        self.params = {key: data[key] for key in ("user", "password", "host", "port", "database")}
+        self.size = int(data.get("pool_size", 4))
+        self.timeout = float(data.get("pool_timeout", 10))
+        self.telemetry = telemetry
+        self.idle = queue.LifoQueue()  # the connection used last is taken first, it is the least likely timed out
+        for _ in range(self.size):
+            conn = PooledConnection(self.params)
+            try:
+                conn.connect()
+            except mariadb.Error as e:
+                print(f"\nError connecting to MariaDB Platform: {e}")
+                sys.exit(1)
+            self.idle.put(conn)
+
+    @contextlib.contextmanager
+    def connection(self):
+        start = time.perf_counter()
         try:
-            conn = mariadb.connect(
-                user=data["user"],
-                password=data["password"],
-                host=data["host"],
-                port=data["port"],
-                database=data["database"]
-            )
-        except mariadb.Error as e:
-            print(f"\nError connecting to MariaDB Platform: {e}")
-            sys.exit(1)
-        return conn
+            conn = self.idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise mariadb.PoolError(f"No free connection within {self.timeout} s")
+        finally:
+            if self.telemetry is not None:
+                self.telemetry.add('pool_wait', time.perf_counter() - start)
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+
+    # Rows of a select if fetch is set, every statement is committed on its own
+    # With many the statement is run for each row of data in one transaction
+    def execute(self, sql, data=(), fetch=False, many=False):
+        with self.connection() as conn:
+            for retry in (False, True):
+                try:
+                    if conn.conn is None:
+                        conn.connect()
+                    with metrics.measure(self.telemetry, 'query'):
+                        cur = conn.cursor(sql)
+                        if many:
+                            cur.executemany(sql, data)
+                        else:
+                            cur.execute(sql, data)
+                        rows = cur.fetchall() if fetch else None
+                        conn.conn.commit()
+                    return rows
+                except (mariadb.InterfaceError, mariadb.OperationalError) as e:
+                    # the connection is opened again on the next try
+                    conn.close()
+                    if retry:
+                        raise
+                    print(f"\nMariaDB connection lost, reconnecting: {e}")
+                except mariadb.Error:
+                    conn.conn.rollback()
+                    raise
+
+    def in_use(self):
+        return self.size - self.idle.qsize()
+
+    def close(self):
+        for _ in range(self.size):
+            self.idle.get().close()
+
+
+class BatchInserter:
+    """Rows collected and inserted with one statement in one transaction, by size or after the interval.
+
+    If the connection fails or no connection of the pool is free, the rows are kept for the next flush.
+    A row the database refuses is written to the rejected file next to the journal instead,
+    so it does not hold back the other rows.
+    Each row is written to the journal before it is taken, the journal is cleared once the rows are committed.
+    Rows left in the journal by a crash are inserted on the next start. A crash between the commit and clearing
+    the journal inserts these rows twice.
+    """
+
+    def __init__(self, pool, sql, batch_size=None, interval=None, journal=None):
+        if batch_size is None:
+            batch_size = FLAGS.db_batch_size
+        if interval is None:
+            interval = FLAGS.db_batch_interval
+        if journal is None:
+            journal = FLAGS.db_journal
+        self.pool = pool
+        self.sql = sql
+        self.batch_size = batch_size
+        self.interval = interval
+        self.journal = journal
+        self.lock = threading.Lock()  # rows and journal
+        self.flush_lock = threading.Lock()  # one flush at a time, so the rows are inserted in order
+        self.rows = self.read_journal()
+        if self.rows:
+            print(f"{len(self.rows)} rows of {journal} not inserted yet")
+        self.file = open(journal, "a")
+        self.inserted = 0
+        self.batches = 0
+        self.rejected = 0
+        self.wake = threading.Event()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="batch_insert", daemon=True)
+        self.thread.start()
+
+    def read_journal(self):
+        if not os.path.exists(self.journal):
+            return []
+        with open(self.journal) as file:
+            # a line cut by a crash was never taken
+            return [json.loads(line) for line in file if line.endswith("\n")]
+
+    # The row is in the journal on the disk when add returns
+    def add(self, row):
+        line = json.dumps(list(row)) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.rows.append(row)
+            full = len(self.rows) >= self.batch_size
+        if full:
+            self.wake.set()
+
+    def run(self):
+        while self.running:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self.flush()
+
+    # True if all rows taken so far are inserted
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                rows, self.rows = self.rows, []
+            if not rows:
+                return True
+            try:
+                self.pool.execute(self.sql, rows, many=True)
+                left = []
+                with self.lock:
+                    self.inserted += len(rows)
+                    self.batches += 1
+            except (mariadb.InterfaceError, mariadb.OperationalError, mariadb.PoolError) as e:
+                print(f"\nMariaDB Error: {e}, {len(rows)} rows are inserted later")
+                left = rows
+            except mariadb.Error as e:
+                # a bad row fails the whole batch, the other rows are inserted one by one
+                print(f"\nMariaDB Error: {e}, the rows are inserted one by one")
+                left = self.insert_each(rows)
+            with self.lock:
+                self.rows = left + self.rows
+                self.write_journal()
+            return not left
+
+    # Rows not inserted because the connection failed or the pool was busy,
+    # rows failing by their data are moved to the rejected file
+    def insert_each(self, rows):
+        for i, row in enumerate(rows):
+            try:
+                self.pool.execute(self.sql, row)
+            except (mariadb.InterfaceError, mariadb.OperationalError, mariadb.PoolError) as e:
+                print(f"\nMariaDB Error: {e}, {len(rows) - i} rows are inserted later")
+                return rows[i:]
+            except mariadb.Error as e:
+                print(f"\nMariaDB Error: {e}, row {row} moved to {self.journal}.rejected")
+                with open(self.journal + ".rejected", "a") as file:
+                    file.write(json.dumps(list(row)) + "\n")
+                with self.lock:
+                    self.rejected += 1
+                continue
+            with self.lock:
+                self.inserted += 1
+        return []
+
+    # Journal with only the rows taken during the last insert
+    def write_journal(self):
+        self.file.close()
+        with open(self.journal + ".tmp", "w") as file:
+            file.writelines(json.dumps(list(row)) + "\n" for row in self.rows)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(self.journal + ".tmp", self.journal)
+        self.file = open(self.journal, "a")
+
+    def waiting(self):
+        with self.lock:
+            return len(self.rows)
+
+    def close(self):
+        self.running = False
+        self.wake.set()
+        self.thread.join()
+        self.flush()
+        self.file.close()
+
+
+class IdAllocator:
+    """Free ids of a table, read once at the start instead of scanning the table for every new row.
+
+    The lowest free id is handed out first, as by the scan. Rows deleted by others while the server runs are not
+    noticed, their ids are reused after a restart.
+    """
+
+    def __init__(self, used):
+        used = sorted(set(used))
+        self.next_id = used[-1] + 1 if used else 0  # all ids from next_id on are free
+        # gaps below next_id as (first, end) ranges, a large id does not cost memory
+        self.free = [(start, end) for start, end in zip([0] + [used_id + 1 for used_id in used], used)
+                     if start < end]
+        heapq.heapify(self.free)
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            if self.free:
+                start, end = heapq.heappop(self.free)
+                if start + 1 < end:
+                    heapq.heappush(self.free, (start + 1, end))
+                return start
+            new_id = self.next_id
+            self.next_id += 1
+            return new_id
+
+    # An id taken but not used, e.g. because its row could not be inserted
+    def give_back(self, free_id):
+        with self.lock:
+            heapq.heappush(self.free, (free_id, free_id + 1))
+
+
+class Database:
+    def __init__(self, config_file=None):
+        self.telemetry = metrics.Telemetry("mariadb")
+        self.pool = ConnectionPool(config_file, self.telemetry)
+        self.cam_ids = IdAllocator(cam_id for cam_id in self.get_column("id", FLAGS.cam_table) if cam_id is not None)
+        self.detections = BatchInserter(
+            self.pool, f"INSERT INTO {FLAGS.det_table} (name, id_object, probability, timestamp, image_path, id_cam) "
+                       f"VALUES (%s, %s, %s, %s, %s, %s)")
 
     def get_column(self, column, table, orderc=None):
-        conn = self.connect_mariadb()
-        cur = conn.cursor()
         items = []
         try:
             sql = f"SELECT {column} FROM {table}"
             if orderc is not None:
                 sql = sql + f" ORDER BY {orderc}"
-            cur.execute(sql)
-            for item in cur:
+            for item in self.pool.execute(sql, fetch=True):
                 items.append(item[0])
         except mariadb.Error as e:
             print(f"\nMariaDB Error: {e}")
-        conn.close()
         return items
 
+    # Row of a new camera with a free id, an id taken by another client in the meantime is skipped
+    # None if the row could not be inserted, the id is kept for the next camera
+    def insert_cam(self, name=None, status=0):
+        while True:
+            new_id = self.cam_ids.take()
+            try:
+                self.pool.execute(f"INSERT INTO {FLAGS.cam_table} (id, name, status) VALUES (%s, %s, %s)",
+                                  (new_id, name, status))
+            except mariadb.IntegrityError:
+                continue
+            except mariadb.Error as e:
+                print(f"\nMariaDB Error: {e}")
+                self.cam_ids.give_back(new_id)
+                return None
+            return new_id
+
     def insert_item(self, item, table):
-        conn = self.connect_mariadb()
-        cur = conn.cursor()
         try:
             if table == FLAGS.cam_table:
-                cur.execute(
+                self.pool.execute(
                     f"INSERT INTO {table} (id, name, status) VALUES (%s, %s, %s)", (item[0], item[1], item[2]))
             elif table == FLAGS.det_table:
-                cur.execute(
-                    f"INSERT INTO {table} (id, name, id_object, probability, timestamp, image_path, id_cam) VALUES "
-                    f"(%s, %s, %s, %s, %s, %s, %s)", (item[0], item[1], item[2], item[3], item[4], item[5], item[6]))
-            conn.commit()
+                # inserted later together with other detections, the id is given by auto increment
+                self.detections.add((item[0], item[1], item[2], item[3], item[4], item[5]))
         except mariadb.Error as e:
             print(f"\nMariaDB Error: {e}")
         except NameError:
@@ -152,39 +480,41 @@ class Database:
         except:
             e = sys.exc_info()[0]
             print(e)
-
-        conn.close()
         return
 
     def update_all_items(self, content, match, column, table):
-        conn = self.connect_mariadb()
-        cur = conn.cursor()
         try:
             if table == FLAGS.cam_table:
                 val = (content[0], content[2], content[3], content[4], match)
                 sql = f"UPDATE {table} SET uptime = %s, name = %s, status = %s, ip = %s WHERE {column} = %s"
-                cur.execute(sql, val)
-            conn.commit()
+                self.pool.execute(sql, val)
         except mariadb.Error as e:
             print(f"\nMariaDB Error: {e}")
-
-        conn.close()
         return
 
     def update_item(self, val, content, column, table):
-        conn = self.connect_mariadb()
-        cur = conn.cursor()
         try:
             if table == FLAGS.cam_table:
                 sql = f"UPDATE {table} SET {val} = %s WHERE {column} = %s"
-                cur.execute(sql, content)
-            conn.commit()
+                self.pool.execute(sql, content)
         except mariadb.Error as e:
             print(f"\nMariaDB Error: {e}")
-
-        conn.close()
         return
 
+    def report(self):
+        summary = self.telemetry.summary()
+        wait = summary.get('pool_wait', {'p50': 0., 'p95': 0.})
+        query = summary.get('query', {'count': 0, 'p50': 0., 'p95': 0.})
+        return (f"Database: {self.pool.in_use()}/{self.pool.size} connections in use, "
+                f"wait p50 {wait['p50']:.1f} ms p95 {wait['p95']:.1f} ms, "
+                f"{query['count']} queries p50 {query['p50']:.1f} ms p95 {query['p95']:.1f} ms, "
+                f"{self.detections.inserted} detections in {self.detections.batches} batches, "
+                f"{self.detections.waiting()} waiting, {self.detections.rejected} rejected")
+
+    def close(self):
+        self.detections.close()
+        self.pool.close()
+
 
 def main(_argv):
     print("Starting Server")
@@ -0,0 +1,120 @@
+"""tracker
+
+This module follows the detected boxes over the frames, so an object staying in the scene fires only once.
+Boxes are matched to the tracks of the same class by their overlap, boxes without enough overlap by the
+distance of their centers. Tracks move on with their last velocity on frames without detections.
+"""
+import statistics
+import numpy as np
+from absl import flags
+
+import nms
+
+FLAGS = flags.FLAGS
+flags.DEFINE_boolean('tracker', False, 'follow the objects over the frames and fire once per object')
+flags.DEFINE_float('track_iou_thresh', 0.3, 'min overlap of a box with the predicted box of a track to match')
+flags.DEFINE_float('track_max_distance', 0.5,
+                   'max distance of the centers to match a box without overlap, relative to the diagonal of the track')
+flags.DEFINE_integer('track_max_age', 15, 'frames a track is kept without a matching box')
+flags.DEFINE_integer('track_scores', 10, 'amount of the last scores of a track used for its median')
+
+
+class Track:
+    def __init__(self, track_id, box, label, score):
+        self.id = track_id
+        self.label = label
+        self.box = box  # predicted box for the next frame after predict, else the last matched box
+        self.velocity = np.zeros(4)  # change of the box per frame
+        self.scores = [score]
+        self.hits = 1  # frames the track was matched
+        self.misses = 0  # frames run through the model since the last match
+        self.moved = 0  # frames the box was moved on since the last match
+        self.fired = False
+
+    def predict(self):
+        self.box = self.box + self.velocity
+        self.moved += 1
+
+    def update(self, box, score):
+        # the box was moved on by the velocity, the difference to the match is the error of the velocity
+        measured = self.velocity + (box - self.box) / max(self.moved, 1)
+        self.velocity = 0.5 * self.velocity + 0.5 * measured
+        self.box = box
+        self.moved = 0
+        self.scores.append(score)
+        del self.scores[:-FLAGS.track_scores]
+        self.hits += 1
+        self.misses = 0
+
+    def score(self):
+        return statistics.median(self.scores)
+
+
+class Tracker:
+    def __init__(self):
+        self.tracks = []
+        self.next_id = 0
+
+    # Matches the selected detections of a frame to the tracks, boxes without a track start a new one
+    def update(self, boxes, labels, scores):
+        boxes = np.asarray(boxes, dtype=np.float64)
+        for track in self.tracks:
+            track.predict()
+            track.misses += 1  # reset by a match
+        matches, new_boxes = self._match(boxes, labels)
+        for track, index in matches:
+            track.update(boxes[index], scores[index])
+        self.tracks = [track for track in self.tracks if track.misses <= FLAGS.track_max_age]
+        for index in new_boxes:
+            self.tracks.append(Track(self.next_id, boxes[index], labels[index], scores[index]))
+            self.next_id += 1
+
+    # Frame not run through the model, the tracks move on but do not age
+    def predict(self):
+        for track in self.tracks:
+            track.predict()
+
+    # Tracks matched in at least min_hits frames that have not fired yet, each track fires once
+    def confirmed(self, min_hits):
+        tracks = [track for track in self.tracks if not track.fired and track.hits >= min_hits]
+        for track in tracks:
+            track.fired = True
+        return tracks
+
+    # Boxes, labels and scores of the fired tracks where they are expected in the current frame
+    def predicted(self):
+        tracks = [track for track in self.tracks if track.fired]
+        boxes = np.array([track.box for track in tracks], dtype=np.float64).reshape(-1, 4)
+        return (boxes.astype(np.int64), np.array([track.label for track in tracks], dtype=np.int64),
+                np.array([track.score() for track in tracks], dtype=np.float64))
+
+    # Greedy matching, best overlap first, then the nearest centers for boxes without enough overlap
+    def _match(self, boxes, labels):
+        if not self.tracks or not len(boxes):
+            return [], list(range(len(boxes)))
+        track_boxes = np.array([track.box for track in self.tracks])
+        track_labels = np.array([track.label for track in self.tracks])
+        same_class = track_labels[:, np.newaxis] == np.asarray(labels)[np.newaxis, :]
+
+        iou = nms.iou_matrix(track_boxes, boxes)
+        track_centers = (track_boxes[:, :2] + track_boxes[:, 2:]) / 2
+        centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+        diagonal = np.maximum(np.linalg.norm(track_boxes[:, 2:] - track_boxes[:, :2], axis=1), 1)
+        distance = np.linalg.norm(track_centers[:, np.newaxis] - centers[np.newaxis], axis=2) / diagonal[:, np.newaxis]
+
+        overlaps = iou >= FLAGS.track_iou_thresh
+        allowed = same_class & (overlaps | (distance <= FLAGS.track_max_distance))
+        # any match by overlap ranks before a match by distance
+        cost = np.where(overlaps, 1 - iou, 1 + distance)
+        rows, cols = np.nonzero(allowed)
+        order = np.argsort(cost[rows, cols], kind='stable')
+
+        matches = []
+        used_tracks, used_boxes = set(), set()
+        for row, col in zip(rows[order].tolist(), cols[order].tolist()):
+            if row in used_tracks or col in used_boxes:
+                continue
+            used_tracks.add(row)
+            used_boxes.add(col)
+            matches.append((self.tracks[row], col))
+        return matches, [index for index in range(len(boxes)) if index not in used_boxes]
@@ -6,7 +6,6 @@ import datetime
 import json
 import socket
 import time
-import re
 import jwt
 from absl import flags
 import requests
@@ -145,14 +144,3 @@ def send_notification(img_name):
     except:
         pass
 
-
-class REMatcher(object):
-    def __init__(self, matchstring):
-        self.matchstring = matchstring
-
-    def match(self, regexp):
-        self.rematch = re.match(regexp, self.matchstring)
-        return bool(self.rematch)
-
-    def group(self, i):
-        return self.rematch.group(i)
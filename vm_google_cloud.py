@@ -6,6 +6,7 @@ Also a connection to the MQTT Bridge is established. (not necessary needed)
 The module handles the receiving of the image, prediction and do entries in the google sql database.
 """
 import os
+import queue
 import sys
 import time
 import numpy as np
@@ -36,6 +37,8 @@ flags.DEFINE_integer('mqtt_bridge_port', 8883, 'MQTT bridge port')
 
 flags.DEFINE_string('mariadblogin', './data/mariadb_config.json', 'file path to the mariadb login data')
 flags.DEFINE_string('det_table', 'detections', 'name of the table containing all detections')
+flags.DEFINE_integer('max_batch_size', 8, 'max amount of queued images run through the model with one invoke')
+flags.DEFINE_float('max_batch_wait', 0.05, 'max time in seconds to wait for further images to fill a batch')
 
 
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = './data/smart-cam-ba-78c8e2da3568.json'
@@ -43,31 +46,51 @@ os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = './data/smart-cam-ba-78c8e2da3568
 
 class Prediction:
     def __init__(self, cam, db):
-        self.queue_img = []
-        self.queue_dev_info = []
+        self.queue_img = queue.Queue()
+        self.obj_handlers = {}  # one per camera, key is the device num id
         self.interpreter = yolov4_tiny.TfLiteInterpreter()
+        # allocated once for the largest batch, smaller batches are padded
+        self.interpreter.reserve_batch(FLAGS.max_batch_size)
         print(self.interpreter.input_details)
         print(self.interpreter.output_details)
 
         s = threading.Thread(target=self.make_predictions, args=(cam,db))
         s.start()
 
+    # Wait for the first image, then collect more until the batch is full or the wait time is over
+    def next_batch(self):
+        batch = [self.queue_img.get()]
+        deadline = time.time() + FLAGS.max_batch_wait
+        while len(batch) < FLAGS.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue_img.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
     def make_predictions(self, cam, db):
         while True:
-            if self.queue_img:
-                image = self.queue_img.pop(0)
-                image, objs_found = self.interpreter.iteration_step(image, image, cam, publish=False)
-                result = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
-                data = self.queue_dev_info.pop(0)
+            batch = self.next_batch()
+            images = [image for image, _ in batch]
+            dev_infos = [data for _, data in batch]
+            obj_handlers = [self.obj_handlers.setdefault(data[1], yolov4_tiny.ObjectsHandler()) for data in dev_infos]
+            results = self.interpreter.iteration_batch(images, images, [cam] * len(batch), publish=False,
+                                                       obj_handlers=obj_handlers)
+            for (image, objs_found), data in zip(results, dev_infos):
                 if objs_found is not None:
+                    # all objects of the frame share the image, it is written and notified once
+                    snapshot = objs_found[0][5]
+                    path = f"./images/{snapshot.img_name}"
+                    img_path_abs = os.path.abspath(path)
+                    snapshot.write(path)
                     for obj in objs_found:
-                        path = f"./images/{obj[4]}"
-                        img_path_abs = os.path.abspath(path)
-                        cv2.imwrite(path, result)
                         item = [obj[0], obj[1], obj[2], obj[3], img_path_abs, int(data[1])]
                         print(item)
                         db.insert_item(item, FLAGS.det_table)
-                        utility.send_notification(obj[4])
+                    utility.send_notification(snapshot.img_name)
 
 
 def receive_messages(cam, db, timeout=None):
@@ -83,13 +106,12 @@ def receive_messages(cam, db, timeout=None):
         if message.attributes["subFolder"] == "image":
             nparr = np.frombuffer(message.data, np.uint8)
             img_decode = cv2.imdecode(nparr, cv2.IMREAD_UNCHANGED)
-            pred.queue_img.append(img_decode)
             device_info = [message.attributes["deviceId"],
                            message.attributes["deviceNumId"],
                            message.attributes["deviceRegistryId"],
                            message.attributes["deviceRegistryLocation"],
                            message.attributes["projectId"]]
-            pred.queue_dev_info.append(device_info)
+            pred.queue_img.put((img_decode, device_info))
 
     streaming_pull_future = subscriber.subscribe(subscription_path, callback=callback)
     print(f"Listening for messages on {subscription_path}..\n")
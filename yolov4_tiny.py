@@ -2,13 +2,20 @@
 
 This module handles the ml model. Also objects are handled.
 """
-import statistics
+import bisect
+import collections
+import queue
+import threading
 import time
 import cv2
 import numpy as np
 import tensorflow as tf
 from absl import flags
 
+import frame_buffer
+import metrics
+import nms
+import tracker
 import utility
 
 FLAGS = flags.FLAGS
@@ -17,299 +24,538 @@ flags.DEFINE_string('classes_file', './data/classes.names', 'path to the .names
 flags.DEFINE_string('color_file', './data/color.txt', 'path to the color information for each class')
 flags.DEFINE_string('model_path', './models/model_person_chicken_cat_car.tflite', 'path to the tflite model used')
 flags.DEFINE_boolean('test', False, 'create testfiles as text and image')
-
-
-class BoundBox:
-    def __init__(self, xmin, ymin, xmax, ymax, objness=None, classes=None):
-        self.xmin = xmin
-        self.ymin = ymin
-        self.xmax = xmax
-        self.ymax = ymax
+flags.DEFINE_boolean('class_agnostic_nms', False, 'suppress overlapping boxes regardless of their class')
+flags.DEFINE_integer('interpreter_count', 1, 'amount of tflite interpreters running frames in parallel')
+flags.DEFINE_integer('interpreter_threads', None, 'threads used by each tflite interpreter, default of tflite if None')
+flags.DEFINE_string('tile_grid', None, 'run the model on a grid of tiles of the frame e.g. 2x2, disabled if None')
+flags.DEFINE_float('tile_overlap', 0.1, 'overlap of neighbouring tiles relative to the tile size')
+flags.DEFINE_string('tile_rois', None, 'path to a file with one region xmin,ymin,xmax,ymax in pixels per line')
+flags.DEFINE_boolean('tile_full_frame', True, 'also run the model on the whole frame, for objects larger than a tile')
+
+
+class Detections:
+    """Boxes of one frame stored in arrays instead of one object per box.
+
+    Candidates of the yolo layers carry the score of every class in classes,
+    selected detections carry one label and score (in percent) per box.
+    Skipped is set for a frame that was not run through the model.
+    """
+    __slots__ = ('boxes', 'objness', 'classes', 'labels', 'scores', 'skipped')
+    _arrays = __slots__[:-1]
+
+    def __init__(self, boxes, objness, classes=None, labels=None, scores=None, skipped=False):
+        self.boxes = boxes  # (N, 4) xmin, ymin, xmax, ymax
         self.objness = objness
         self.classes = classes
-        self.label = -1
-        self.score = -1
+        self.labels = labels
+        self.scores = scores
+        self.skipped = skipped
 
-    def get_label(self):
-        if self.label == -1:
-            self.label = np.argmax(self.classes)
+    def __len__(self):
+        return len(self.boxes)
 
-        return self.label
-
-    def get_score(self):
-        if self.score == -1:
-            self.score = self.classes[self.get_label()]
+    @staticmethod
+    def empty(skipped=False):
+        return Detections(np.zeros((0, 4), dtype=np.int64), np.zeros(0, dtype=np.float32),
+                          labels=np.zeros(0, dtype=np.int64), scores=np.zeros(0, dtype=np.float32), skipped=skipped)
 
-        return self.score
+    @staticmethod
+    def concatenate(detections):
+        detections = list(detections)
+        if len(detections) == 1:
+            return detections[0]
+        fields = []
+        for field in Detections._arrays:
+            arrays = [getattr(dets, field) for dets in detections]
+            fields.append(None if arrays[0] is None else np.concatenate(arrays))
+        return Detections(*fields)
+
+    def select(self, thresh, num_classes):
+        # many labels may trigger for one box
+        rows, labels = np.nonzero(self.classes[:, :num_classes] > thresh)
+        return Detections(self.boxes[rows], self.objness[rows], labels=labels,
+                          scores=self.classes[rows, labels] * 100)
+
+    def best_per_class(self):
+        """Labels found in the frame and the highest score of each label."""
+        labels, index = np.unique(self.labels, return_inverse=True)
+        scores = np.zeros(len(labels), dtype=self.scores.dtype)
+        np.maximum.at(scores, index, self.scores)
+        return labels, scores
+
+    def to_yolo(self, img_height, img_width, with_scores=False):
+        """Lines of label center_x center_y width height relative to the image size, the score appended if asked."""
+        boxes = self.boxes / [img_width, img_height, img_width, img_height]
+        centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+        sizes = boxes[:, 2:] - boxes[:, :2]
+        lines = ""
+        for label, score, (center_x, center_y), (width, height) in zip(self.labels.tolist(), self.scores.tolist(),
+                                                                       centers.tolist(), sizes.tolist()):
+            lines += str(label) + " " + str(center_x) + " " + str(center_y) + " " + str(width) + " " + str(height)
+            if with_scores:
+                lines += " " + str(score)
+            lines += "\n"
+        return lines
 
 
 class TfLiteInterpreter:
     obj_thresh = 0.5
     class_threshold = 0.5
+    nms_thresh = 0.5
     anchors = [[81, 82, 135, 169, 344, 319], [10, 14, 23, 27, 37, 58]]
     scales_x_y = [1.05, 1.05]
 
     # Start the Tf Lite Interpreter
-    def __init__(self):
+    def __init__(self, num_threads=None):
+        if num_threads is None:
+            num_threads = FLAGS.interpreter_threads
         self.obj_handler = ObjectsHandler()
-        self.interpreter = tf.lite.Interpreter(model_path=FLAGS.model_path)
+        self.interpreter = tf.lite.Interpreter(model_path=FLAGS.model_path, num_threads=num_threads)
         self.interpreter.allocate_tensors()
         self.input_details = self.interpreter.get_input_details()
         self.output_details = self.interpreter.get_output_details()
+        self.input_index = self.input_details[0]['index']
+        # scale and zero point, (0.0, 0) for a float model
+        self.input_quantization = self.input_details[0]['quantization']
+        self.batch_size = self.input_details[0]['shape'][0]
 
     # All steps for one frame
-    def iteration_step(self, frame, image_data, cam, publish=True):
-        image_data = image_data / 255.  # Int -> Float64
-        image_data = image_data[np.newaxis, ...].astype(np.float32)
-        self.interpreter.set_tensor(self.input_details[0]['index'], image_data)
+    def iteration_step(self, frame, image_data, cam, publish=True, obj_handler=None):
+        detections = self.predict(image_data, cam.img_height, cam.img_width, getattr(cam, 'telemetry', None))
+        return self.handle_detections(frame, detections, cam, publish, obj_handler)
+
+    # All steps for several frames with one invoke of the model, cams and obj_handlers belong to the frames
+    def iteration_batch(self, frames, images_data, cams, publish=True, obj_handlers=None):
+        if obj_handlers is None:
+            obj_handlers = [None] * len(frames)
+        pred = self.invoke(images_data)
+        results = []
+        for i in range(len(frames)):
+            results.append(self.post_process(frames[i], [layer[i] for layer in pred], cams[i], publish,
+                                             obj_handlers[i]))
+        return results
+
+    # The input only grows, smaller batches are padded, so the tensors are not allocated again for every batch
+    def reserve_batch(self, batch_size):
+        if batch_size > self.batch_size:
+            self.interpreter.resize_tensor_input(self.input_index,
+                                                 [batch_size, FLAGS.input_size, FLAGS.input_size, 3])
+            self.interpreter.allocate_tensors()
+            self.batch_size = batch_size
+
+    # Run the model on a batch of images, returns the output of each yolo layer with the batch as first dim
+    # Places of the batch without an image keep their old input, their output is cut off
+    def invoke(self, images_data):
+        batch_size = len(images_data)
+        self.reserve_batch(batch_size)
+        # the images are written straight into the input tensor of the interpreter
+        input_tensor = self.interpreter.tensor(self.input_index)()
+        for i, image_data in enumerate(images_data):
+            self.write_input(image_data, input_tensor[i], self.input_quantization)
+        # no reference to the tensor may be held while invoking
+        del input_tensor
         self.interpreter.invoke()
-        class_pred = self.interpreter.get_tensor(self.output_details[0]['index'])
-        box_pred = self.interpreter.get_tensor(self.output_details[1]['index'])
-        pred = [class_pred, box_pred]
+        return [self.read_output(details)[:batch_size] for details in self.output_details[:2]]
 
+    @staticmethod
+    def write_input(image_data, out, quantization):
+        scale, zero_point = quantization
+        if out.dtype == np.float32:
+            # scaled in chunks, no float64 copy of the whole image
+            np.divide(image_data, 255., out=out, casting='unsafe')  # Int -> Float32
+        elif abs(scale * 255. - 1.) < 1e-3 and ((out.dtype == np.uint8 and zero_point == 0) or
+                                               (out.dtype == np.int8 and zero_point == -128)):
+            # quantized input of [0, 1] is the pixel itself, shifted by the zero point for int8
+            np.add(image_data, np.int16(zero_point), out=out, casting='unsafe')
+        else:
+            info = np.iinfo(out.dtype)
+            quantized = np.round(image_data / (255. * scale)) + zero_point
+            np.clip(quantized, info.min, info.max, out=quantized)
+            out[...] = quantized
+
+    def read_output(self, details):
+        output = self.interpreter.get_tensor(details['index'])
+        if output.dtype != np.float32:
+            scale, zero_point = details['quantization']
+            output = (output.astype(np.float32) - zero_point) * np.float32(scale)
+        return output
+
+    # Model and boxes of one frame, nothing of the object state is touched
+    def predict(self, image_data, img_height, img_width, telemetry=None):
+        with metrics.measure(telemetry, 'invoke'):
+            pred = self.invoke([image_data])
+        return self.detect([layer[0] for layer in pred], img_height, img_width, telemetry)
+
+    def post_process(self, frame, pred, cam, publish=True, obj_handler=None):
+        detections = self.detect(pred, cam.img_height, cam.img_width)
+        return self.handle_detections(frame, detections, cam, publish, obj_handler)
+
+    # Boxes and nms of one frame, pred holds the output of each yolo layer for this frame
+    def detect(self, pred, img_height, img_width, telemetry=None):
+        with metrics.measure(telemetry, 'decode'):
+            candidates = self.decode_candidates(pred, img_height, img_width)
+        with metrics.measure(telemetry, 'nms'):
+            self.do_nms(candidates, TfLiteInterpreter.nms_thresh)
+            return self.get_boxes(candidates, TfLiteInterpreter.class_threshold)
+
+    # Candidates of all yolo layers in image coordinates, before the nms
+    def decode_candidates(self, pred, img_height, img_width):
         # Compute the Yolo layers
-        boxes = list()
+        decoded = list()
         for i in range(len(TfLiteInterpreter.anchors)):
             # decode the output of the network
-            boxes += self.decode_netout(pred[i][0], TfLiteInterpreter.anchors[i], TfLiteInterpreter.obj_thresh,
-                                        FLAGS.input_size, 3, TfLiteInterpreter.scales_x_y[i])
-
-        self.correct_yolo_boxes(boxes, cam.img_height, cam.img_width)
-        self.do_nms(boxes, 0.5)
+            decoded.append(self.decode_netout(pred[i], TfLiteInterpreter.anchors[i], TfLiteInterpreter.obj_thresh,
+                                              FLAGS.input_size, 3, TfLiteInterpreter.scales_x_y[i]))
+        candidates = Detections.concatenate(decoded)
+
+        self.correct_yolo_boxes(candidates, img_height, img_width)
+        return candidates
+
+    # Run the model on every tile of the frame, the nms is done across the tiles in frame coordinates
+    def predict_tiles(self, frame, tiles, telemetry=None):
+        frame = frame_buffer.wrap(frame)
+        tile_candidates = []
+        for xmin, ymin, xmax, ymax in tiles:
+            with metrics.measure(telemetry, 'resize'):
+                image_data = frame.region(xmin, ymin, xmax, ymax, FLAGS.input_size)
+            with metrics.measure(telemetry, 'invoke'):
+                pred = self.invoke([image_data])
+            with metrics.measure(telemetry, 'decode'):
+                candidates = self.decode_candidates([layer[0] for layer in pred], ymax - ymin, xmax - xmin)
+                candidates.boxes += [xmin, ymin, xmin, ymin]
+            tile_candidates.append(candidates)
+        if not tile_candidates:
+            return Detections.empty()
+        candidates = Detections.concatenate(tile_candidates)
+        with metrics.measure(telemetry, 'nms'):
+            self.do_nms(candidates, TfLiteInterpreter.nms_thresh)
+            return self.get_boxes(candidates, TfLiteInterpreter.class_threshold)
+
+    # Tiles of the frame as (xmin, ymin, xmax, ymax) from the regions file or the grid, None if tiling is disabled
+    @staticmethod
+    def make_tiles(img_height, img_width):
+        tiles = []
+        if FLAGS.tile_rois is not None:
+            rois = utility.read_info(FLAGS.tile_rois)
+            for i in rois:
+                if rois[i].strip():
+                    xmin, ymin, xmax, ymax = map(int, rois[i].split(','))
+                    # clipped to the frame, an empty crop can not be resized for the model
+                    xmin, xmax = (min(max(x, 0), img_width) for x in (xmin, xmax))
+                    ymin, ymax = (min(max(y, 0), img_height) for y in (ymin, ymax))
+                    if xmin >= xmax or ymin >= ymax:
+                        raise ValueError(f"Error: region {rois[i].strip()} of {FLAGS.tile_rois} has no area "
+                                         f"inside the frame of {img_width}x{img_height}")
+                    tiles.append((xmin, ymin, xmax, ymax))
+        elif FLAGS.tile_grid is not None:
+            cols, rows = map(int, FLAGS.tile_grid.lower().split('x'))
+            tile_w = img_width / (cols - (cols - 1) * FLAGS.tile_overlap)
+            tile_h = img_height / (rows - (rows - 1) * FLAGS.tile_overlap)
+            for row in range(rows):
+                for col in range(cols):
+                    xmin = int(col * tile_w * (1 - FLAGS.tile_overlap))
+                    ymin = int(row * tile_h * (1 - FLAGS.tile_overlap))
+                    # the last tiles end with the frame
+                    xmax = img_width if col == cols - 1 else int(xmin + tile_w)
+                    ymax = img_height if row == rows - 1 else int(ymin + tile_h)
+                    tiles.append((xmin, ymin, xmax, ymax))
+        else:
+            return None
+        if FLAGS.tile_full_frame:
+            tiles.append((0, 0, img_width, img_height))
+        return tiles
+
+    # Detections of a frame, from its tiles, from image_data or none if the frame was skipped
+    def predict_frame(self, frame, image_data, tiles, img_height, img_width, telemetry=None):
+        if tiles is not None:
+            return self.predict_tiles(frame, tiles, telemetry)
+        if image_data is None:
+            return Detections.empty(skipped=True)
+        return self.predict(image_data, img_height, img_width, telemetry)
+
+    # Object handling of one frame, the boxes are drawn once the window or the publisher needs the image
+    # Frames given as array are RGB
+    def handle_detections(self, frame, detections, cam, publish=True, obj_handler=None):
+        if obj_handler is None:
+            obj_handler = self.obj_handler
+        frame = frame_buffer.wrap(frame)
         if FLAGS.test:
-            self.create_test(boxes, frame, cam.img_height, cam.img_width)
-        v_boxes, v_labels, v_scores, v_colors, v_label_nums = self.get_boxes(boxes,
-                                                                             TfLiteInterpreter.class_threshold)
-
-        bboxes = v_boxes, v_scores, v_label_nums, len(v_boxes), v_colors
-        self.obj_handler.append_object(bboxes=bboxes)
-        image = self.draw_bbox(frame, bboxes)
-        cam.last_img = image
-        obj_found = self.obj_handler.object_iteration(cam, publish)
-        return image, obj_found
-
-    def decode_netout(self, netout, anchors, obj_thresh, net_size, nb_box, scales_x_y):
-        grid_h, grid_w = netout.shape[:2]
-        netout = netout.reshape((grid_h, grid_w, nb_box, -1))
+            self.create_test(detections, frame, cam.img_height, cam.img_width)
 
-        boxes = []
-        netout[..., :2] = self._sigmoid(netout[..., :2])  # x, y
-        netout[..., :2] = netout[..., :2] * scales_x_y - 0.5 * (scales_x_y - 1.0)  # scale x, y
+        obj_handler.append_object(detections)
+        if detections.skipped and obj_handler.tracker is not None:
+            # the tracked objects are drawn where they are expected
+            boxes, labels, scores = obj_handler.tracker.predicted()
+            detections = Detections(boxes, np.zeros(len(boxes)), labels=labels, scores=scores, skipped=True)
+        telemetry = getattr(cam, 'telemetry', None)
 
-        netout[..., 4:] = self._sigmoid(netout[..., 4:])  # objectness + classes probabilities
+        def draw(image, order):
+            with metrics.measure(telemetry, 'draw'):
+                self.draw_bbox(image, detections, order)
 
-        for i in range(grid_h * grid_w):
-
-            row = i / grid_w
-            col = i % grid_w
-
-            for b in range(nb_box):
-                # 4th element is objectness
-                objectness = netout[int(row)][int(col)][b][4]
-
-                if objectness > obj_thresh:
-                    # print("objectness: ", objectness)
-
-                    # first 4 elements are x, y, w, and h
-                    x, y, w, h = netout[int(row)][int(col)][b][:4]
-                    x = (col + x) / grid_w  # center position, unit: image width
-                    y = (row + y) / grid_h  # center position, unit: image height
-                    w = anchors[2 * b + 0] * np.exp(w) / net_size  # unit: image width
-                    h = anchors[2 * b + 1] * np.exp(h) / net_size  # unit: image height
-
-                    # last elements are class probabilities
-                    classes = objectness * netout[int(row)][col][b][5:]
-                    classes *= classes > obj_thresh
-                    box = BoundBox(x - w / 2, y - h / 2, x + w / 2, y + h / 2, objectness, classes)
-                    boxes.append(box)
-        return boxes
+        frame.annotate(draw)
+        cam.last_img = frame
+        obj_found = obj_handler.object_iteration(cam, publish)
+        return frame, obj_found
 
     @staticmethod
-    def correct_yolo_boxes(boxes, image_h, image_w):
-        for i in range(len(boxes)):
-            # times 1.0 because of division with zero
-            # images all the same dim
-            boxes[i].xmin = int(boxes[i].xmin / 1.0 * image_w)
-            boxes[i].xmax = int(boxes[i].xmax / 1.0 * image_w)
-            boxes[i].ymin = int(boxes[i].ymin / 1.0 * image_h)
-            boxes[i].ymax = int(boxes[i].ymax / 1.0 * image_h)
+    def decode_netout(netout, anchors, obj_thresh, net_size, nb_box, scales_x_y):
+        grid_h, grid_w = netout.shape[:2]
+        netout = netout.reshape((grid_h, grid_w, nb_box, -1))
+
+        # 4th element is objectness, threshold it once for all cells and anchors
+        objectness = TfLiteInterpreter._sigmoid(netout[..., 4])
+        rows, cols, b = np.nonzero(objectness > obj_thresh)
+        objectness = objectness[rows, cols, b]
+        hits = netout[rows, cols, b]
+
+        # first 4 elements are x, y, w, and h
+        xy = TfLiteInterpreter._sigmoid(hits[:, :2])
+        xy = xy * scales_x_y - 0.5 * (scales_x_y - 1.0)  # scale x, y
+        xy = xy.astype(np.float64)
+        wh = np.exp(hits[:, 2:4]).astype(np.float64)
+
+        # the row offset is the fractional i / grid_w, same as in the former per cell loop
+        row = (rows * grid_w + cols) / grid_w
+        x = (cols + xy[:, 0]) / grid_w  # center position, unit: image width
+        y = (row + xy[:, 1]) / grid_h  # center position, unit: image height
+        anchors = np.asarray(anchors).reshape(nb_box, 2)
+        w = anchors[b, 0] * wh[:, 0] / net_size  # unit: image width
+        h = anchors[b, 1] * wh[:, 1] / net_size  # unit: image height
+
+        # last elements are class probabilities
+        classes = objectness[:, np.newaxis] * TfLiteInterpreter._sigmoid(hits[:, 5:])
+        classes *= classes > obj_thresh
+
+        boxes = np.stack((x - w / 2, y - h / 2, x + w / 2, y + h / 2), axis=1)
+        return Detections(boxes, objectness, classes)
 
     @staticmethod
-    def _interval_overlap(interval_a, interval_b):
-        x1, x2 = interval_a
-        x3, x4 = interval_b
-        if x3 < x1:
-            if x4 < x1:
-                return 0
-            else:
-                return min(x2, x4) - x1
-        else:
-            if x2 < x3:
-                return 0
-            else:
-                return min(x2, x4) - x3
+    def correct_yolo_boxes(detections, image_h, image_w):
+        # times 1.0 because of division with zero
+        # images all the same dim
+        detections.boxes = (detections.boxes / 1.0 * [image_w, image_h, image_w, image_h]).astype(np.int64)
 
     @staticmethod
     def _sigmoid(x):
         return 1. / (1. + np.exp(-x))
 
-    def bbox_iou(self, box1, box2):
-        intersect_w = self._interval_overlap([box1.xmin, box1.xmax], [box2.xmin, box2.xmax])
-        intersect_h = self._interval_overlap([box1.ymin, box1.ymax], [box2.ymin, box2.ymax])
-        intersect = intersect_w * intersect_h
-        w1, h1 = box1.xmax - box1.xmin, box1.ymax - box1.ymin
-        w2, h2 = box2.xmax - box2.xmin, box2.ymax - box2.ymin
-        union = w1 * h1 + w2 * h2 - intersect
-        return float(intersect) / union
-
-    def do_nms(self, boxes, nms_thresh):
-        if len(boxes) > 0:
-            nb_class = len(boxes[0].classes)
-        else:
-            return
-        for c in range(nb_class):
-            sorted_indices = np.argsort([-box.classes[c] for box in boxes])
-            for i in range(len(sorted_indices)):
-                index_i = sorted_indices[i]
-                if boxes[index_i].classes[c] == 0:
-                    continue
-                for j in range(i + 1, len(sorted_indices)):
-                    index_j = sorted_indices[j]
-                    if self.bbox_iou(boxes[index_i], boxes[index_j]) >= nms_thresh:
-                        boxes[index_j].classes[c] = 0
+    @staticmethod
+    def do_nms(detections, nms_thresh):
+        # suppressed boxes get the score of the class set to zero
+        nms.non_max_suppression(detections.boxes, detections.classes, nms_thresh,
+                                class_agnostic=FLAGS.class_agnostic_nms)
 
     # get all of the results above a threshold
-    def get_boxes(self, boxes, thresh):
-        v_boxes, v_labels, v_scores, v_colors = list(), list(), list(), list()
-        v_label_nums = []
-        # enumerate all boxes
-        for box in boxes:
-            # enumerate all possible labels
-            for i in range(self.obj_handler.num_classes):
-
-                # check if the threshold for this label is high enough
-                if box.classes[i] > thresh:
-                    v_boxes.append(box)
-                    v_labels.append(self.obj_handler.classes[i])
-                    v_label_nums.append(i)
-                    v_scores.append(box.classes[i] * 100)
-                    v_colors.append(self.obj_handler.colors[i])
-                    # don't break, many labels may trigger for one box
-        return v_boxes, v_labels, v_scores, v_colors, v_label_nums
-
-    def draw_bbox(self, image, bboxes):
+    def get_boxes(self, detections, thresh):
+        return detections.select(thresh, self.obj_handler.num_classes)
+
+    # The colors of the classes are RGB, they are reversed to draw into a BGR image
+    def draw_bbox(self, image, detections, order='RGB'):
         image_h, image_w, _ = image.shape
+        font_scale = 0.5
+        bbox_thick = int(0.5 * (image_h + image_w) / 600)
 
-        out_boxes, out_scores, out_classes, num_boxes, v_colors = bboxes
-        for i in range(num_boxes):
-            if int(out_classes[i]) < 0 or int(out_classes[i]) > self.obj_handler.num_classes:
-                continue
-            coor = [out_boxes[i].ymin, out_boxes[i].xmin, out_boxes[i].ymax, out_boxes[i].xmax]
-            font_scale = 0.5
-            score = out_scores[i]
-            class_ind = int(out_classes[i])
-            bbox_thick = int(0.5 * (image_h + image_w) / 600)
-            top_left, bottom_right = (coor[1], coor[0]), (coor[3], coor[2])
+        for (xmin, ymin, xmax, ymax), score, class_ind in zip(detections.boxes.tolist(), detections.scores.tolist(),
+                                                              detections.labels.tolist()):
+            color = self.obj_handler.colors[class_ind]
+            if order == 'BGR':
+                color = color[::-1]
+            top_left, bottom_right = (xmin, ymin), (xmax, ymax)
 
-            cv2.rectangle(image, top_left, bottom_right, v_colors[i], bbox_thick)
+            cv2.rectangle(image, top_left, bottom_right, color, bbox_thick)
 
             label_txt = '%s: %.2f' % (self.obj_handler.classes[class_ind], score)
             t_size = cv2.getTextSize(label_txt, 0, font_scale, thickness=bbox_thick // 2)[0]
             coor_text_box_end = (top_left[0] + t_size[0], top_left[1] - t_size[1] - 5)
             coor_text_start = (top_left[0], (top_left[1] - 2))
-            cv2.rectangle(image, top_left, coor_text_box_end, v_colors[i], -1)  # filled
+            cv2.rectangle(image, top_left, coor_text_box_end, color, -1)  # filled
             cv2.putText(image, label_txt, coor_text_start, cv2.FONT_HERSHEY_SIMPLEX,
                         font_scale, (0, 0, 0), bbox_thick // 2, lineType=cv2.LINE_AA)
         return image
 
-    def create_test(self, boxes, frame, image_h, image_w):
-        re_boxes, re_labels, = list(), list()
-        re_label_nums = []
-        labels = ""
-        for j, box in enumerate(boxes):
-            for i in range(self.obj_handler.num_classes):
-                if box.classes[i] > TfLiteInterpreter.class_threshold:
-                    re_boxes.append(box)
-                    re_labels.append(i)
-                    re_label_nums.append(i)
-        for i in range(len(re_boxes)):
-            center_x = ((boxes[i].xmax / image_w) + (boxes[i].xmin / image_w)) / 2
-            center_y = ((boxes[i].ymax / image_h) + (boxes[i].ymin / image_h)) / 2
-            width = (boxes[i].xmax / image_w) - (boxes[i].xmin / image_w)
-            height = (boxes[i].ymax / image_h) - (boxes[i].ymin / image_h)
-            labels += str(re_labels[i]) + " " + str(center_x) + " " + str(center_y) + " " + str(width) + " " +\
-                      str(height) + "\n"
+    @staticmethod
+    def create_test(detections, frame, image_h, image_w):
+        # yolo format: label center_x center_y width height, relative to the image size
+        labels = detections.to_yolo(image_h, image_w)
         path = "./test/image_" + str(time.time_ns())
         file_name_img = path + ".jpg"
         file_name_txt = path + ".txt"
-        frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-        cv2.imwrite(file_name_img, frame)
+        cv2.imwrite(file_name_img, frame.view('BGR'))
         f = open(file_name_txt, "a")
         f.write(labels)
         f.close()
 
 
+class InterpreterPool:
+    """Several interpreters running frames from one shared work queue.
+
+    Frames are submitted per camera and results are handed back in the order the frames of that camera were
+    submitted. The object handling stays with the caller, because it depends on the frame order.
+    """
+
+    def __init__(self, num_interpreters=None, num_threads=None):
+        if num_interpreters is None:
+            num_interpreters = FLAGS.interpreter_count
+        self.interpreters = [TfLiteInterpreter(num_threads) for _ in range(num_interpreters)]
+        self.interpreter = self.interpreters[0]  # for the object handling and drawing
+        self.work = queue.Queue(maxsize=2 * num_interpreters)
+        self.cond = threading.Condition()
+        self.next_seq = {}  # next sequence number of a submitted frame per camera
+        self.next_ready = {}  # sequence number of the next frame to hand out per camera
+        self.pending = {}  # finished frames per camera, key is the sequence number
+        self.ready = []
+        self.workers = [threading.Thread(target=self.work_loop, args=(interpreter,), daemon=True)
+                        for interpreter in self.interpreters]
+        for worker in self.workers:
+            worker.start()
+
+    def work_loop(self, interpreter):
+        while True:
+            job = self.work.get()
+            if job is None:
+                return
+            cam, seq, frame, image_data, tiles = job
+            # cpu time of this thread only, the other interpreters run at the same time
+            cpu_time = time.thread_time()
+            detections = interpreter.predict_frame(frame, image_data, tiles, cam.img_height, cam.img_width,
+                                                   getattr(cam, 'telemetry', None))
+            cpu_time = time.thread_time() - cpu_time
+            with self.cond:
+                self.pending[cam][seq] = (cam, frame, detections, cpu_time)
+                # hand out all frames of this camera that are now complete in order
+                while self.next_ready[cam] in self.pending[cam]:
+                    self.ready.append(self.pending[cam].pop(self.next_ready[cam]))
+                    self.next_ready[cam] += 1
+                self.cond.notify_all()
+
+    # Blocks if all interpreters are busy and the work queue is full, image_data None skips the model
+    # With tiles the model runs on the tiles of the frame instead of image_data
+    def submit(self, frame, image_data, cam, tiles=None):
+        with self.cond:
+            if cam not in self.next_seq:
+                self.next_seq[cam] = 0
+                self.next_ready[cam] = 0
+                self.pending[cam] = {}
+            seq = self.next_seq[cam]
+            self.next_seq[cam] += 1
+        self.work.put((cam, seq, frame, image_data, tiles))
+
+    # Finished frames as (cam, frame, detections, cpu_time), waits up to timeout if none is finished yet
+    def results(self, timeout=None):
+        with self.cond:
+            if not self.ready and timeout != 0:
+                self.cond.wait(timeout)
+            ready, self.ready = self.ready, []
+        return ready
+
+    def close(self):
+        for _ in self.workers:
+            self.work.put(None)
+        for worker in self.workers:
+            worker.join()
+
 
 class ObjectsHandler:
     def __init__(self):
-        self.detected_objects = []
+        self.detected_objects = {}  # objects with any state left, key is the class id
         self.classes = utility.read_info(FLAGS.classes_file)
         colors_str = utility.read_info(FLAGS.color_file)
         self.colors = [tuple(map(int, colors_str[i].split(','))) for i in colors_str]
         self.num_classes = len(self.classes)
-
-    def append_object(self, bboxes):
-        classes_already_checked = []
-
-        out_boxes, out_scores, out_classes, num_boxes, _ = bboxes
-        for i in range(num_boxes):
-
-            score = out_scores[i]
-            class_ind = int(out_classes[i])
-
-            checked = False
-            for added_class in classes_already_checked:
-                if added_class[0] == class_ind:
-                    checked = True
-                    if added_class[1] < score:
-                        added_class[1] = score
-            if not checked:
-                classes_already_checked.append([class_ind, score])
-
-        for found_classes in classes_already_checked:
-            exists = False
-            for objects in self.detected_objects:
-                if found_classes[0] == objects.id:
-                    exists = True
-                    objects.count_recent = objects.count_recent + 1
-                    objects.add_prob(found_classes[1])
-                    objects.just_added = True
-                    break
-            if not exists:
-                new_class = DetectedObject(self.classes[found_classes[0]], found_classes[0])
-                new_class.add_prob(found_classes[1])
-                self.detected_objects.append(new_class)
+        self.recent = DetectedObject.recent  # frames an object has to be found in, for each camera on its own
+        self.min_time_detected = DetectedObject.min_time_detected
+        self.skipped = False  # last frame was not run through the model
+        self.decay_time = None  # time up to which the objects have decayed
+        self.tracker = tracker.Tracker() if FLAGS.tracker else None
+
+    # The window of frames follows the frames per second of the model, so it always spans min_time_detected
+    # Small changes are ignored, so the window does not jitter with the measured fps
+    def update_window(self, fps):
+        recent = max(int(fps * self.min_time_detected), 2)
+        if abs(recent - self.recent) <= self.recent * 0.1:
+            return False
+        self.recent = recent
+        return True
+
+    def append_object(self, detections):
+        self.skipped = detections.skipped
+        if self.tracker is not None:
+            if detections.skipped:
+                self.tracker.predict()
+            else:
+                self.tracker.update(detections.boxes, detections.labels.tolist(), detections.scores.tolist())
+            return
+        labels, scores = detections.best_per_class()
+
+        for class_ind, score in zip(labels.tolist(), scores):
+            objects = self.detected_objects.get(class_ind)
+            if objects is not None:
+                objects.count_recent = objects.count_recent + 1
+                objects.add_prob(score, self.recent)
+                objects.just_added = True
+            else:
+                new_class = DetectedObject(self.classes[class_ind], class_ind)
+                new_class.add_prob(score, self.recent)
+                self.detected_objects[class_ind] = new_class
 
     def object_iteration(self, cam, publish=True):
         all_detec_data = []
-        for obj in self.detected_objects:
-            if obj.count_recent >= DetectedObject.recent:
-                cam.last_img = cv2.cvtColor(cam.last_img, cv2.COLOR_RGB2BGR)
-                obj.img_name = f"{cam.name}_{obj.name}_{utility.get_datetime(file_format=True)}.jpg"
-                if publish:
-                    obj.publish_mqtt(cam)
-                else:  # currently the case, if on Google Cloud
-                    obj.img_name = f"{obj.name}_{utility.get_datetime(file_format=True)}_{time.time_ns()}.jpg"
-                    all_detec_data.append(obj.return_detected_obj())
-            else:
-                if not obj.just_added:
-                    obj.decr_stats()
-            obj.just_added = False
+        snapshot = None  # all objects firing in this frame share the converted and encoded image
+        for obj in self.firing_objects():
+            if snapshot is None:
+                snapshot = FrameSnapshot(cam.last_img, getattr(cam, 'telemetry', None))
+            obj.img_name = f"{cam.name}_{obj.name}_{utility.get_datetime(file_format=True)}.jpg"
+            if publish:
+                obj.publish_mqtt(cam, snapshot)
+            else:  # currently the case, if on Google Cloud
+                # the image is stored once, named after the first object of the frame
+                if snapshot.img_name is None:
+                    snapshot.img_name = f"{obj.name}_{utility.get_datetime(file_format=True)}_{time.time_ns()}.jpg"
+                obj.img_name = snapshot.img_name
+                all_detec_data.append(obj.return_detected_obj(snapshot))
         if all_detec_data:
             return all_detec_data
         else:
             return None
 
+    # Objects that fire in this frame, each is reset by the caller before the next one is taken
+    def firing_objects(self):
+        if self.tracker is not None:
+            # a new track fires once, instead of every time its class was found often enough
+            for track in self.tracker.confirmed(self.recent):
+                obj = DetectedObject(self.classes[track.label], track.label)
+                obj.prob_med = track.score()
+                yield obj
+            return
+
+        steps = self.decay_steps()
+        for obj in list(self.detected_objects.values()):
+            if obj.count_recent >= self.recent:
+                yield obj
+            elif not obj.just_added:
+                for _ in range(steps):
+                    obj.decr_stats()
+            obj.just_added = False
+            # an object without state is the same as a new one, so only classes seen lately cost time
+            if obj.count_recent == 0 and len(obj.probs) == 0:
+                del self.detected_objects[obj.id]
+
+
+    # Steps the objects decay in this frame, one for a frame run through the model
+    # Frames skipped by the motion gate decay them by the frames the model would have run in the meantime,
+    # so an object only fires if it was found within min_time_detected
+    def decay_steps(self):
+        now = time.perf_counter()
+        if not self.skipped or self.decay_time is None:
+            self.decay_time = now
+            return 0 if self.skipped else 1
+        interval = self.min_time_detected / self.recent
+        steps = int((now - self.decay_time) / interval)
+        self.decay_time += steps * interval
+        # after recent steps nothing is left to decay
+        return min(steps, self.recent)
+
 
 class DetectedObject:
     recent = 5
@@ -321,50 +567,145 @@ class DetectedObject:
         self.count_recent = 1
         self.just_added = True
         self.prob_med = 0
-        self.probs = []
+        self.probs = RollingMedian()
         self.time = utility.get_datetime()
         self.img_name = None
 
-    def publish_mqtt(self, cam):
-        _, img_encode = cv2.imencode('.jpg', cam.last_img)
-        data_encode = np.array(img_encode)
-        str_encode = data_encode.tobytes()
-
-        print(f"Cam {cam.id}: publish: {self.id}<:>{self.prob_med}<:>{self.img_name}<:>{self.time}")
-
-        cam.client.publish(f"{cam.topic}/{cam.mqtt_topics['detection_info']}/{self.name}",
-                           f"{self.id}<:>{self.prob_med}<:>{self.img_name}<:>{self.time}",
-                           retain=False, qos=1)
-        cam.client.publish(f"{cam.topic}/{cam.mqtt_topics['image']}/{self.img_name}",
-                           str_encode,
-                           retain=False, qos=1)
+    # Adds the detection to the publisher of the cam, without a publisher it is published right away
+    def publish_mqtt(self, cam, snapshot=None):
+        event = DetectionEvent(cam, self, snapshot)
+        if getattr(cam, 'publisher', None) is not None:
+            cam.publisher.put(event)
+        else:
+            event.publish()
         self.reset_obj()
         return
 
-    def return_detected_obj(self):
-        data = [self.name, self.id, self.prob_med, self.time, self.img_name]
+    def return_detected_obj(self, snapshot=None):
+        data = [self.name, self.id, self.prob_med, self.time, self.img_name, snapshot]
         self.reset_obj()
         return data
 
-    def add_prob(self, prob):
-        if len(self.probs) >= DetectedObject.recent:
-            self.probs.pop(0)
-        self.probs.append(prob)
-        self.prob_med = statistics.median(self.probs)
+    def add_prob(self, prob, recent=None):
+        if recent is None:
+            recent = DetectedObject.recent
+        self.probs.append(prob, recent)
+        self.prob_med = self.probs.median()
         self.time = utility.get_datetime()
 
     def decr_stats(self):
         if self.count_recent > 0:
             self.count_recent = self.count_recent - 1
         if len(self.probs) > 0:
-            self.probs.pop(0)
-            if len(self.probs) == 0:
-                self.prob_med = 0
-            else:
-                self.prob_med = statistics.median(self.probs)
+            self.probs.popleft()
+            self.prob_med = self.probs.median()
 
     def reset_obj(self):
         self.count_recent = 0
-        self.probs = []
+        self.probs.clear()
         self.prob_med = 0
         self.just_added = False
+
+
+class RollingMedian:
+    """Median of the last values, kept up to date when a value is added or the oldest one removed.
+
+    The values are kept in order of arrival and sorted, so the median is taken without sorting the window.
+    """
+
+    def __init__(self):
+        self.values = collections.deque()
+        self.sorted = []
+
+    def __len__(self):
+        return len(self.values)
+
+    # Adds the value and removes the oldest ones, so at most size values are kept
+    def append(self, value, size):
+        while len(self.values) >= size:
+            self.popleft()
+        self.values.append(value)
+        bisect.insort(self.sorted, value)
+
+    def popleft(self):
+        value = self.values.popleft()
+        del self.sorted[bisect.bisect_left(self.sorted, value)]
+
+    def clear(self):
+        self.values.clear()
+        self.sorted.clear()
+
+    # Same as statistics.median, 0 without values
+    def median(self):
+        count = len(self.sorted)
+        if count == 0:
+            return 0
+        mid = count // 2
+        if count % 2:
+            return self.sorted[mid]
+        return (self.sorted[mid - 1] + self.sorted[mid]) / 2
+
+
+class FrameSnapshot:
+    """Image of a frame in which objects fired, drawn and encoded to jpg only once and only if needed.
+
+    The snapshot is shared by all detections of the frame, the encoding may be done by the publisher thread.
+    """
+
+    def __init__(self, image, telemetry=None):
+        self.image = frame_buffer.wrap(image)  # the boxes are drawn by the frame buffer
+        self.telemetry = telemetry
+        self.img_name = None  # name of the stored image, if the frame is stored once for all objects
+        self._jpg = None
+        self.lock = threading.Lock()
+
+    @property
+    def bgr(self):
+        return self.image.annotated('BGR')
+
+    @property
+    def jpg(self):
+        bgr = self.bgr
+        with self.lock:
+            if self._jpg is None:
+                with metrics.measure(self.telemetry, 'encode'):
+                    _, img_encode = cv2.imencode('.jpg', bgr)
+                    self._jpg = img_encode.tobytes()
+            return self._jpg
+
+    def write(self, path):
+        with open(path, 'wb') as file:
+            file.write(self.jpg)
+
+
+class DetectionEvent:
+    """A detection to publish, the values are taken from the object when it fires."""
+
+    def __init__(self, cam, obj, snapshot=None):
+        self.cam = cam
+        self.id = obj.id
+        self.name = obj.name
+        self.prob_med = obj.prob_med
+        self.img_name = obj.img_name
+        self.time = obj.time
+        if snapshot is None:
+            snapshot = FrameSnapshot(cam.last_img, getattr(cam, 'telemetry', None))
+        self.snapshot = snapshot
+
+    def encode(self):
+        return self.snapshot.jpg
+
+    def publish(self, str_encode=None):
+        cam = self.cam
+        if str_encode is None:
+            str_encode = self.encode()
+
+        print(f"Cam {cam.id}: publish: {self.id}<:>{self.prob_med}<:>{self.img_name}<:>{self.time}")
+
+        with metrics.measure(getattr(cam, 'telemetry', None), 'publish'):
+            cam.client.publish(f"{cam.topic}/{cam.mqtt_topics['detection_info']}/{self.name}",
+                               f"{self.id}<:>{self.prob_med}<:>{self.img_name}<:>{self.time}",
+                               retain=False, qos=1)
+            cam.client.publish(f"{cam.topic}/{cam.mqtt_topics['image']}/{self.img_name}",
+                               str_encode,
+                               retain=False, qos=1)